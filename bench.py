@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+####
+## micro-benchmarks for pwdgen's hot paths
+##
+## runs on any linux box, no pi needed
+## results are json so runs can be saved and compared:
+##     ./bench.py -o baseline.json
+##     (change things)
+##     ./bench.py --baseline baseline.json
+####
+
+## imports
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+import pwdgen
+
+
+## constants
+# dictionary sizes, in words, benchmarked by default
+DICT_SIZES = (1000, 20000, 100000)
+# [password] option sets, applied on top of BASE_OPTIONS
+OPTIONS = (('plain', {}),
+           ('words4', {'pwd_words':4}),
+           ('leet', {'pwd_leet':True}),
+           ('random-case', {'pwd_case':'random'}),
+           ('digits', {'pwd_prefixd':2, 'pwd_suffixd':2}),
+           ('all', {'pwd_words':4, 'pwd_leet':True, 'pwd_case':'random',
+                    'pwd_prefixd':2, 'pwd_suffixd':2}))
+BASE_OPTIONS = {'pwd_minlength':4,
+                'pwd_maxlength':7,
+                'pwd_words':2,
+                'pwd_seperator':'.',
+                'pwd_leet':False,
+                'pwd_prefixd':0,
+                'pwd_suffixd':0,
+                'pwd_case':'lower',
+                'pwd_template':'',
+                'pwd_compact':False}
+# passwords per genpasswords() call
+GENERATE_COUNT = 1000
+# a typical password for the leet and hid report benchmarks
+SAMPLE_PASSWORD = 'correct.horse.battery.staple'
+
+
+## benchmarks
+# each returns (function to time, items per call), optionally followed
+# by a function taking the timing result and returning extra figures
+
+def benchloadtext(path, cfg):
+    """loadwordlist() from the text file, no cache"""
+    return (lambda: pwdgen.loadwordlist(path, cfg['pwd_minlength'],
+                                        cfg['pwd_maxlength']), 1)
+
+def benchloadcache(path, cfg):
+    """loadwordlist() from a warm cache"""
+    cache_dir = os.path.join(os.path.dirname(path), 'cache')
+    pwdgen.loadwordlist(path, cfg['pwd_minlength'], cfg['pwd_maxlength'],
+                        cache_dir)
+    return (lambda: pwdgen.loadwordlist(path, cfg['pwd_minlength'],
+                                        cfg['pwd_maxlength'], cache_dir), 1)
+
+def benchgenpwd(path, cfg, rng):
+    """one genpwd() call"""
+    wordlist = pwdgen.loadwordlist(path, cfg['pwd_minlength'],
+                                   cfg['pwd_maxlength'])
+    template = pwdgen.compiletemplate(cfg)
+    return (lambda: pwdgen.genpwd(wordlist, rng, cfg, template), 1)
+
+def benchgenpasswords(path, cfg, rng):
+    """one genpasswords() call for GENERATE_COUNT passwords"""
+    wordlist = pwdgen.loadwordlist(path, cfg['pwd_minlength'],
+                                   cfg['pwd_maxlength'])
+    cfg = dict(cfg, pwd_generate=GENERATE_COUNT)
+    return (lambda: pwdgen.genpasswords(wordlist, rng, cfg), GENERATE_COUNT)
+
+def benchentropy(path, cfg, backend):
+    """one genpwd() call with a secure rng, counting entropy reads
+
+    Each os.urandom() call is at least one syscall.
+    """
+    wordlist = pwdgen.loadwordlist(path, cfg['pwd_minlength'],
+                                   cfg['pwd_maxlength'])
+    template = pwdgen.compiletemplate(cfg)
+    calls = [0]
+    urandom = os.urandom
+    def counted(n):
+        calls[0] += 1
+        return urandom(n)
+    # SystemRandom keeps its own reference to urandom
+    os.urandom = random._urandom = counted
+    rng = pwdgen.getrng(backend)
+    def extra(result):
+        # plus one for the warm up call
+        return {'urandom_calls_per_item':calls[0] / float(result['items'] + 1)}
+    return (lambda: pwdgen.genpwd(wordlist, rng, cfg, template), 1, extra)
+
+def benchleet():
+    return (lambda: pwdgen.leet(SAMPLE_PASSWORD), 1)
+
+def benchencode():
+    return (lambda: pwdgen.hidkey.encode(SAMPLE_PASSWORD), 1)
+
+
+## functions
+def makedict(path, size, rng):
+    """write a synthetic dictionary of size distinct words to path
+
+    Word lengths run from 2 to 12 letters, peaking around 6, with a few
+    capitalised and possessive entries to be filtered out as in a real
+    dictionary.
+    """
+    seen = set()
+    with open(path, 'w') as d:
+        while len(seen) < size:
+            word = ''.join(rng.choice(string.ascii_lowercase)
+                           for i in xrange(max(2, min(12, int(rng.gauss(6, 2))))))
+            if word in seen:
+                continue
+            seen.add(word)
+            r = rng.random()
+            if r < 0.05:
+                word = word.capitalize()
+            elif r < 0.1:
+                word += "'s"
+            d.write(word + '\n')
+
+def getbenchmarks(dicts, cfg):
+    """return list of (name, setup) for every benchmark
+
+    setup is called in the process that runs the benchmark and returns
+    (function to time, items per call). Generation uses the default rng
+    backend, as pwdgen does, so rng costs are part of the figures.
+    """
+    benchmarks = []
+    for size, path in dicts:
+        benchmarks.append(('loadwordlist/%d/text' % size,
+                           lambda path=path: benchloadtext(path, cfg)))
+        benchmarks.append(('loadwordlist/%d/cache' % size,
+                           lambda path=path: benchloadcache(path, cfg)))
+        for name, options in OPTIONS:
+            optcfg = dict(cfg, **options)
+            benchmarks.append(('genpwd/%d/%s' % (size, name),
+                               lambda path=path, optcfg=optcfg:
+                                   benchgenpwd(path, optcfg,
+                                               pwdgen.getrng())))
+            benchmarks.append(('genpasswords/%d/%s' % (size, name),
+                               lambda path=path, optcfg=optcfg:
+                                   benchgenpasswords(path, optcfg,
+                                                     pwdgen.getrng())))
+        for backend in pwdgen.RNG_BACKENDS:
+            optcfg = dict(cfg, **dict(OPTIONS)['all'])
+            benchmarks.append(('entropy/%d/%s' % (size, backend),
+                               lambda path=path, optcfg=optcfg,
+                                      backend=backend:
+                                   benchentropy(path, optcfg, backend)))
+    benchmarks.append(('leet', benchleet))
+    benchmarks.append(('hidkey.encode', benchencode))
+    return benchmarks
+
+def percentile(ordered, p):
+    """return the p'th percentile of an ordered list"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+def timebench(func, items, duration, min_calls):
+    """time calls of func for at least duration seconds and min_calls calls"""
+    func()  # warm up
+    latencies = []
+    start = time.time()
+    end = start + duration
+    now = start
+    while now < end or len(latencies) < min_calls:
+        t = now
+        func()
+        now = time.time()
+        latencies.append(now - t)
+    elapsed = now - start
+    latencies.sort()
+    return {'calls':len(latencies),
+            'items':len(latencies) * items,
+            'seconds':elapsed,
+            'items_per_sec':len(latencies) * items / elapsed,
+            'latency_us':dict(('p%d' % p, percentile(latencies, p) * 1e6)
+                              for p in (50, 90, 99)),
+            }
+
+def runbench(name, setup, duration, min_calls):
+    """run one benchmark in a child process and return its result
+
+    A fresh process per benchmark keeps peak memory figures separate and
+    stops one benchmark's garbage slowing the next.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 0
+        try:
+            try:
+                bench = setup()
+                result = timebench(bench[0], bench[1], duration, min_calls)
+                if len(bench) > 2:
+                    result.update(bench[2](result))
+            except Exception as e:
+                result = {'error':'%s: %s' % (type(e).__name__, e)}
+                status = 1
+            with os.fdopen(w, 'w') as out:
+                json.dump(result, out)
+        finally:
+            os._exit(status)
+    os.close(w)
+    with os.fdopen(r) as res:
+        data = res.read()
+    pid, status, usage = os.wait4(pid, 0)
+    try:
+        result = json.loads(data)
+    except ValueError:
+        result = {'error':'benchmark process died (status %d)' % status}
+    result['name'] = name
+    # ru_maxrss is in kilobytes on linux
+    result['peak_rss_kb'] = usage.ru_maxrss
+    return result
+
+def compare(results, baseline, tolerance, out=sys.stderr):
+    """write a comparison of results against baseline to out
+
+    Returns the names of benchmarks whose throughput fell by more than
+    tolerance.
+    """
+    base = dict((r['name'], r) for r in baseline['results'])
+    regressed = []
+    out.write('%-32s %12s %12s %8s\n' % ('benchmark', 'baseline/s', 'now/s',
+                                         'change'))
+    for r in results:
+        b = base.get(r['name'])
+        if b is None or 'error' in b or 'error' in r:
+            continue
+        change = r['items_per_sec'] / b['items_per_sec'] - 1
+        flag = ''
+        if change < -tolerance:
+            regressed.append(r['name'])
+            flag = ' !'
+        out.write('%-32s %12.0f %12.0f %+7.1f%%%s\n'
+                  % (r['name'], b['items_per_sec'], r['items_per_sec'],
+                     change * 100, flag))
+    return regressed
+
+def getargs():
+    parser = argparse.ArgumentParser(description='Benchmark pwdgen hot paths.')
+    parser.add_argument('-o','--output',
+                        metavar='FILE',
+                        help='write results to FILE instead of stdout.')
+    parser.add_argument('-b','--baseline',
+                        metavar='FILE',
+                        help='compare against results saved in FILE. Exits with status 1 on a regression.')
+    parser.add_argument('-t','--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='fractional slowdown counted as a regression. Default 0.2.')
+    parser.add_argument('-d','--duration',
+                        type=float,
+                        default=1.0,
+                        help='seconds to run each benchmark for. Default 1.')
+    parser.add_argument('--min-calls',
+                        type=int,
+                        default=5,
+                        help='least calls timed per benchmark. Default 5.')
+    parser.add_argument('-s','--sizes',
+                        type=int,
+                        nargs='+',
+                        default=DICT_SIZES,
+                        metavar='N',
+                        help='synthetic dictionary sizes. Default %s.'
+                             % ' '.join(str(s) for s in DICT_SIZES))
+    parser.add_argument('-f','--filter',
+                        metavar='TEXT',
+                        help='only run benchmarks whose name contains TEXT.')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=936,
+                        help='seed for the synthetic dictionaries. Default 936.')
+    return parser.parse_args()
+
+
+## main
+if __name__ == '__main__':
+    args = getargs()
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+
+    cfg = dict(BASE_OPTIONS)
+    workdir = tempfile.mkdtemp(prefix='pwdgen-bench-')
+    try:
+        dicts = []
+        for size in args.sizes:
+            path = os.path.join(workdir, 'words-%d' % size)
+            makedict(path, size, random.Random(args.seed))
+            dicts.append((size, path))
+
+        results = []
+        for name, setup in getbenchmarks(dicts, cfg):
+            if args.filter and args.filter not in name:
+                continue
+            result = runbench(name, setup, args.duration, args.min_calls)
+            if 'error' in result:
+                sys.stderr.write('%-32s %s\n' % (name, result['error']))
+            else:
+                sys.stderr.write('%-32s %12.0f/s  p50 %9.1fus  p99 %9.1fus'
+                                 '  %7dkB\n'
+                                 % (name, result['items_per_sec'],
+                                    result['latency_us']['p50'],
+                                    result['latency_us']['p99'],
+                                    result['peak_rss_kb']))
+                if 'urandom_calls_per_item' in result:
+                    sys.stderr.write('%-32s %12.3f urandom calls per password\n'
+                                     % ('', result['urandom_calls_per_item']))
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'meta':{'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'python':platform.python_version(),
+                      'platform':platform.platform(),
+                      'machine':platform.machine(),
+                      'numpy':numpy_version,
+                      'seed':args.seed,
+                      'rng':pwdgen.getrng().__class__.__name__,
+                      'duration':args.duration},
+              'results':results}
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as b:
+            baseline = json.load(b)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -10,17 +10,129 @@
 ####
 
 ## imports
+import time
+# for --profile-startup, as early as possible
+g_startup = [('start', time.time())]
+
 import argparse
+import array
+import bisect
+import collections
 import ConfigParser
+import csv
+import errno
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import math
 import os
+import Queue
 import random
+import select
+import signal
+import stat
+import string
+import struct
 import sys
 import textwrap
 import threading
-import time
 
-import gpiozero
+# gpiozero, socket, SocketServer and tempfile are imported where used
+# so console only runs do not pay for them
+
+g_startup.append(('imports', time.time()))
+
+
+## globals
+g_clock_overhead = None
+# set to ask long running modes to exit
+g_shutdown = threading.Event()
+# (read, write) ends of the self pipe that wakes the main loop
+g_wakeup = None
+# set by SIGHUP to ask button mode to reload its config
+g_reload = threading.Event()
+
+
+## constants
+WORDCACHE_MAGIC = 'pwdgen-wordlist-2'
+LEET_TABLE = string.maketrans('aeiolst', '4310157')
+# genpasswords() switches to genbatch() from this many passwords
+BATCH_MIN = 64
+# passwords generated per genbatch() call, bounds temporary memory
+BATCH_SIZE = 8192
+# redraw rounds before genbatch() falls back to sampling each password
+BATCH_REDRAWS = 4
+# --unique keeps an exact set up to this many passwords, then a bloom filter
+UNIQUE_SET_MAX = 1000000
+UNIQUE_ERROR_RATE = 0.00001
+# consecutive repeats after which --unique gives up
+UNIQUE_MAX_MISSES = 100000
+# draws of a total_min/total_max password that repeat a word before giving up
+LENGTH_MAX_REDRAWS = 1000
+# batches each worker process may have queued in --jobs mode
+POOL_BACKLOG = 2
+# usb hid keyboard report size and writer pacing limits, in seconds
+HID_REPORT_SIZE = 8
+HID_MIN_INTERVAL = 0.0005
+HID_MAX_INTERVAL = 0.05
+HID_MAX_BACKOFF = 0.5
+# auto pacing interval is scaled by this after each report that is accepted
+HID_DECAY = 0.99
+# lcdproc connect timeout and longest wait between reconnects, in seconds
+LCDPROC_TIMEOUT = 5
+LCDPROC_MAX_BACKOFF = 30
+# lines kept for an LCDd display whose size is not known yet
+LCDPROC_DEFAULT_ROWS = 4
+# calls each devicequeue holds before callers have to wait
+DEVICE_QUEUE_SIZE = 64
+# seconds the button is held down for to shut down
+BUTTON_HOLD_TIME = 3
+# letter case options
+CASES = ('lower', 'upper', 'title', 'random')
+# most passwords a --serve request may ask for
+SERVE_MAX_COUNT = 100000
+# most words, prefix or suffix digits and characters (template, seperators,
+# word and total lengths) a --serve request may ask for, so a client
+# cannot make the server do unbounded work
+SERVE_MAX_WORDS = 16
+SERVE_MAX_DIGITS = 32
+SERVE_MAX_LENGTH = 256
+# --serve request fields and the config keys they override
+SERVE_OVERRIDES = {'count':'pwd_generate',
+                   'words':'pwd_words',
+                   'min':'pwd_minlength',
+                   'max':'pwd_maxlength',
+                   'case':'pwd_case',
+                   'leet':'pwd_leet',
+                   'seperator':'pwd_seperator',
+                   'prefix_digits':'pwd_prefixd',
+                   'suffix_digits':'pwd_suffixd',
+                   'template':'pwd_template',
+                   'total_min':'pwd_totalmin',
+                   'total_max':'pwd_totalmax'}
+# config key prefixes and the pwdgen.cfg sections they come from
+CONFIG_SECTIONS = {'pwd':'password',
+                   'lcd':'lcd',
+                   'hdd44780':'hd44780',
+                   'lcdproc':'lcdproc',
+                   'button':'button',
+                   'daemon':'daemon',
+                   'stats':'stats',
+                   'hidkey':'hidkeyboard'}
+# console output formats
+OUTPUT_FORMATS = ('newline', 'nul', 'csv', 'json')
+# bytes of kernel entropy bufferedrandom reads at a time
+RNG_BLOCK_SIZE = 4096
+# [password] rng backends
+RNG_BACKENDS = ('buffered', 'system')
+# upper bounds of the latency histogram buckets, in seconds
+STATS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# [stats] export file formats
+STATS_FORMATS = ('json', 'prometheus')
 
 
 ## clases
@@ -40,21 +152,292 @@ class lcd(object):
         """write message to display"""
         pass
 
+    def flush(self):
+        """push out any buffered output"""
+        pass
+
+    def cancel(self):
+        """drop output queued but not yet written"""
+        pass
+
+    def wait(self, timeout=None):
+        """wait for output already written to finish, return True if it did"""
+        return True
+
     def close(self):
         """clean up"""
         pass
     
+class histogram(object):
+    """latency histogram over STATS_BUCKETS, not thread safe on its own"""
+
+    def __init__(self):
+        # the last bucket counts anything over the largest bound
+        self.buckets = [0] * (len(STATS_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(STATS_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """return an estimate of quantile q
+
+        Interpolated within the bucket holding it, as prometheus does.
+        """
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(STATS_BUCKETS, self.buckets):
+            if n and seen + n >= rank:
+                upper = min(bound, self.max)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return self.max
+
+class stagetimer(object):
+    """context manager timing a block into a statsregistry histogram"""
+
+    def __init__(self, registry, name, labels):
+        self.__registry = registry
+        self.__name = name
+        self.__labels = labels
+
+    def __enter__(self):
+        self.__start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.__registry.observe(self.__name, time.time() - self.__start,
+                                **self.__labels)
+        return False
+
+class statsregistry(object):
+    """in process counters and latency histograms
+
+    Metrics are identified by a name and optional labels, for example
+    observe('device_seconds', 0.01, device='hd44780', call='write').
+    Recording takes a lock and a few additions so it is cheap enough to
+    leave on. Counts made in --jobs worker processes are not included.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__histograms = {}
+
+    def metric(self, name, **labels):
+        """return the key for name and labels, for use with record()"""
+        return (name, tuple(sorted(labels.items())))
+
+    def count(self, name, n=1, **labels):
+        key = self.metric(name, **labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        self.record(self.metric(name, **labels), seconds)
+
+    def record(self, key, seconds):
+        """observe seconds for a key made by metric()"""
+        with self.__lock:
+            h = self.__histograms.get(key)
+            if h is None:
+                h = self.__histograms[key] = histogram()
+            h.observe(seconds)
+
+    def timer(self, name, **labels):
+        """return a context manager that times its block"""
+        return stagetimer(self, name, labels)
+
+    def snapshot(self):
+        """return a json serialisable copy of all metrics"""
+        with self.__lock:
+            counters = [{'name':name, 'labels':dict(labels), 'value':value}
+                        for (name, labels), value
+                        in sorted(self.__counters.items())]
+            histograms = [{'name':name, 'labels':dict(labels),
+                           'count':h.count, 'sum':h.sum, 'max':h.max,
+                           'p50':h.quantile(0.5), 'p99':h.quantile(0.99),
+                           'buckets':list(h.buckets)}
+                          for (name, labels), h
+                          in sorted(self.__histograms.items())]
+        return {'time':time.time(), 'bounds':list(STATS_BUCKETS),
+                'counters':counters, 'histograms':histograms}
+
+    def tojson(self):
+        return json.dumps(self.snapshot(), sort_keys=True) + '\n'
+
+    def toprometheus(self):
+        """return metrics in the prometheus text exposition format"""
+        snap = self.snapshot()
+        lines = []
+        typed = set()
+        def labelstr(labels, **extra):
+            labels = dict(labels, **extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, labels[k])
+                                     for k in sorted(labels))
+        for c in snap['counters']:
+            name = 'pwdgen_%s_total' % c['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %d' % (name, labelstr(c['labels']),
+                                      c['value']))
+        for h in snap['histograms']:
+            name = 'pwdgen_%s_seconds' % h['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            total = 0
+            for bound, n in zip(STATS_BUCKETS + ('+Inf',), h['buckets']):
+                total += n
+                lines.append('%s_bucket%s %d'
+                             % (name, labelstr(h['labels'], le=bound), total))
+            lines.append('%s_sum%s %r' % (name, labelstr(h['labels']),
+                                          h['sum']))
+            lines.append('%s_count%s %d' % (name, labelstr(h['labels']),
+                                            h['count']))
+        return '\n'.join(lines) + '\n'
+
+    def report(self, out=sys.stderr):
+        """write a human readable summary to out, for --stats"""
+        snap = self.snapshot()
+        def label(m):
+            if not m['labels']:
+                return m['name']
+            return '%s{%s}' % (m['name'], ','.join('%s=%s' % kv for kv
+                                                   in sorted(m['labels'].items())))
+        for c in snap['counters']:
+            out.write('%-40s %10d\n' % (label(c), c['value']))
+        if snap['histograms']:
+            out.write('%-40s %10s %10s %10s %10s %10s\n'
+                      % ('', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'))
+        for h in snap['histograms']:
+            out.write('%-40s %10d %10.3f %10.3f %10.3f %10.3f\n'
+                      % (label(h), h['count'], h['sum'] * 1000 / h['count'],
+                         h['p50'] * 1000, h['p99'] * 1000, h['max'] * 1000))
+
+    def export(self, path, format='json'):
+        """atomically write metrics to path
+
+        Written to a temporary file in the same directory and renamed so
+        readers, such as node_exporter's textfile collector, never see a
+        partial file.
+        """
+        if format == 'prometheus':
+            data = self.toprometheus()
+        else:
+            data = self.tojson()
+        tmpname = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmpname, 'w') as f:
+                f.write(data)
+            os.rename(tmpname, path)
+        except:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            raise
+
+# process wide registry, see --stats and the [stats] config section
+g_stats = statsregistry()
+
+class statsexporter(threading.Thread):
+    """writes g_stats to a file every interval seconds
+
+    For long running modes. The file is also worth writing once more at
+    exit, which is left to the caller.
+    """
+
+    def __init__(self, path, format='json', interval=60):
+        threading.Thread.__init__(self, name='statsexporter')
+        self.daemon = True
+        self.__path = path
+        self.__format = format
+        self.__interval = interval
+
+    def run(self):
+        while not g_shutdown.is_set():
+            # sleep rather than Event.wait(), which polls under python 2
+            time.sleep(self.__interval)
+            try:
+                g_stats.export(self.__path, self.__format)
+            except (IOError, OSError) as e:
+                logging.warning('Unable to write stats to %s (%s)'
+                                % (self.__path, e))
+
+class timeddevice(lcd):
+    """times each call made to an output device into g_stats
+
+    Only used when stats are wanted as it adds a little to every write.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        name = devicename(device)
+        self.__keys = dict((m, g_stats.metric('device', device=name, call=m))
+                           for m in ('reset', 'launch', 'write', 'flush'))
+
+    def reset(self):
+        self.__call('reset')
+
+    def launch(self):
+        self.__call('launch')
+
+    def write(self, line, message):
+        """write message to display"""
+        self.__call('write', line, message)
+
+    def flush(self):
+        """push out any buffered output"""
+        self.__call('flush')
+
+    def cancel(self):
+        """drop output queued but not yet written"""
+        self.device.cancel()
+
+    def wait(self, timeout=None):
+        """wait for output already written to finish, return True if it did"""
+        return self.device.wait(timeout)
+
+    def close(self):
+        """clean up"""
+        self.device.close()
+
+    def __call(self, method, *args):
+        start = time.time()
+        try:
+            getattr(self.device, method)(*args)
+        finally:
+            g_stats.record(self.__keys[method], time.time() - start)
+
 class hd44780(lcd):
     """hd44870 lcd
 
     Based on code from http://www.raspberrypi-spy.co.uk/2012/07/16x2-lcd-module-control-using-python/
     Rewritten to use gpiozero instead of RPi.GPIO
+
+    Bytes are sent through transport, an hd44780gpio or hd44780i2c. If
+    not given an hd44780gpio is created from the pin numbers.
     """
 
     CHR = True
     CMD = False
-    PULSE = 0.0005
-    DELAY = 0.0005
+    # datasheet timings, in seconds
+    PULSE = 0.0000005
+    DELAY = 0.00004
+    CLEAR_DELAY = 0.002
+    INIT_DELAY = 0.0045
 
     def __init__(self,
                  enabled=False,
@@ -65,17 +448,13 @@ class hd44780(lcd):
                  d6=None,
                  d7=None,
                  en=None,
-                 rs=None):
+                 rs=None,
+                 transport=None):
         
         self.__enabled = enabled
         self.__rows = rows
         self.__cols = cols
-        self.__d4 = d4
-        self.__d5 = d5
-        self.__d6 = d6
-        self.__d7 = d7
-        self.__en = en
-        self.__rs = rs
+        self.__transport = transport
 
         lcdsize = '%sx%s' % (self.__cols, self.__rows)
         logging.debug('LCD size %s' % lcdsize)
@@ -84,8 +463,8 @@ class hd44780(lcd):
         if ( lcdsize == '16x2'
              or lcdsize == '20x2'
              or lcdsize == '40x2' ):
-            self.__lineaddr = {1:0x80,
-                               2:0xC0}
+            self.__lineaddrs = {1:0x80,
+                                2:0xC0}
         elif lcdsize == '16x4':
             self.__lineaddrs = {1:0x80,
                                 2:0xC0,
@@ -100,15 +479,14 @@ class hd44780(lcd):
             logging.warning('Unsupported LCD size (%s). HD44780 output disabled.' % lcdsize)
             self.__enabled = False
 
+        # shadow copy of what is on each line and the current ddram
+        # address, so only changed characters need to be sent
+        self.__shadow = {}
+        self.__cursor = None
+
         if self.__enabled:
-            # setup gpio
-            self.__lcdpins = {'d4':gpiozero.OutputDevice(self.__d4),
-                              'd5':gpiozero.OutputDevice(self.__d5),
-                              'd6':gpiozero.OutputDevice(self.__d6),
-                              'd7':gpiozero.OutputDevice(self.__d7),
-                              'en':gpiozero.OutputDevice(self.__en),
-                              'rs':gpiozero.OutputDevice(self.__rs)
-                              }
+            if self.__transport is None:
+                self.__transport = hd44780gpio(d4, d5, d6, d7, en, rs)
             self.reset()
         
         return
@@ -116,88 +494,341 @@ class hd44780(lcd):
     def reset(self):
         """reset lcd"""
         if self.__enabled:
-            self.__sendbyte(0x33, hd44780.CMD)
-            self.__sendbyte(0x32, hd44780.CMD)
-            self.__sendbyte(0x06, hd44780.CMD)
-            self.__sendbyte(0x0C, hd44780.CMD)
-            self.__sendbyte(0x28, hd44780.CMD)
-            self.__sendbyte(0x01, hd44780.CMD)
-            time.sleep(hd44780.DELAY)
+            # force 4 bit mode from any starting state
+            for nibble in (0x3, 0x3, 0x3, 0x2):
+                self.__transport.write4(nibble, hd44780.CMD)
+                time.sleep(hd44780.INIT_DELAY)
+            # 2 lines, display on, cursor off, increment, clear
+            self.__transport.send(bytearray([0x28, 0x0C, 0x06, 0x01]),
+                                  hd44780.CMD)
+            time.sleep(hd44780.CLEAR_DELAY)
+            # clear display fills ddram with spaces and homes the cursor
+            self.__shadow = dict((r, ' ' * self.__cols)
+                                 for r in range(1, self.__rows + 1))
+            self.__cursor = self.__lineaddrs[1]
 
     def write(self, line, message):
-        """write message to display"""
+        """write message to display
+
+        Only the characters that differ from what is already displayed are
+        sent, relying on the address auto increment within each run.
+        """
         if self.__enabled and line <= self.__rows:
-            message = message.ljust(self.__cols, ' ')
-            self.__sendbyte(self.__lineaddrs[line], hd44780.CMD)
-            for i in range(self.__cols):
-                self.__sendbyte(ord(message[i]), hd44780.CHR)
+            message = message.ljust(self.__cols, ' ')[:self.__cols]
+            old = self.__shadow[line]
+            if message == old:
+                return
+            base = self.__lineaddrs[line]
+            cols = self.__cols
+            i = 0
+            while i < cols:
+                if message[i] == old[i]:
+                    i += 1
+                    continue
+                # extend the run while it is no cheaper to set the address
+                # again than to resend one unchanged character
+                end = i + 1
+                while end < cols and (message[end] != old[end]
+                                      or (end + 1 < cols
+                                          and message[end + 1] != old[end + 1])):
+                    end += 1
+                if self.__cursor != base + i:
+                    self.__transport.send(bytearray([base + i]), hd44780.CMD)
+                self.__transport.send(bytearray(message[i:end]), hd44780.CHR)
+                self.__cursor = base + end
+                i = end
+            self.__shadow[line] = message
                 
     def close(self):
         """clean up"""
-        for v in self.__lcdpins.itervalues():
-            v.close()
-        self.__lcdpins.clear()
+        if self.__transport is not None:
+            self.__transport.close()
+            self.__transport = None
         self.__enabled = False
 
-    def __sendbyte(self, data, mode):
-        """send byte to lcd"""
-        
-        if self.__enabled:
-            # set mode
-            self.__lcdpins['rs']. value = mode
-            # send high bits
-            self.__lcdpins['d4'].off()
-            self.__lcdpins['d5'].off()
-            self.__lcdpins['d6'].off()
-            self.__lcdpins['d7'].off()
-            if data&0x10==0x10:
-                self.__lcdpins['d4'].on()
-            if data&0x20==0x20:
-                self.__lcdpins['d5'].on()
-            if data&0x40==0x40:
-                self.__lcdpins['d6'].on()
-            if data&0x80==0x80:
-                self.__lcdpins['d7'].on()
-            # clock out the bits
-            self.__blipenable()
-            # send low bits
-            self.__lcdpins['d4'].off()
-            self.__lcdpins['d5'].off()
-            self.__lcdpins['d6'].off()
-            self.__lcdpins['d7'].off()
-            if data&0x01==0x01:
-                self.__lcdpins['d4'].on()
-            if data&0x02==0x02:
-                self.__lcdpins['d5'].on()
-            if data&0x04==0x04:
-                self.__lcdpins['d6'].on()
-            if data&0x08==0x08:
-                self.__lcdpins['d7'].on()
-            # clock out the bits
-            self.__blipenable()
-
-    def __blipenable(self):
-        """blip the lcd enable pin"""
-        if self.__enabled:
-            time.sleep(hd44780.DELAY)
-            self.__lcdpins['en'].on()
-            time.sleep(hd44780.PULSE)
-            self.__lcdpins['en'].off()
-            time.sleep(hd44780.DELAY)
+class hd44780gpio(object):
+    """hd44780 transport using gpio pins directly
+
+    Pins are only changed when their value differs from the last one
+    written. Timing uses calibrated busy waits as time.sleep() cannot
+    wait for less than tens of microseconds. pin_factory is passed to
+    gpiozero, e.g. a MockFactory for testing.
+    """
+
+    def __init__(self, d4, d5, d6, d7, en, rs, pin_factory=None):
+        import gpiozero
+        if pin_factory is None:
+            kwargs = {}
+        else:
+            kwargs = {'pin_factory':pin_factory}
+        self.__data = [gpiozero.OutputDevice(p, **kwargs)
+                       for p in (d4, d5, d6, d7)]
+        self.__en = gpiozero.OutputDevice(en, **kwargs)
+        self.__rs = gpiozero.OutputDevice(rs, **kwargs)
+        self.__state = [False] * 4
+        self.__mode = None
+        calibrateclock()
+
+    def write4(self, nibble, mode):
+        """clock out the low 4 bits of nibble"""
+        if mode != self.__mode:
+            self.__rs.value = mode
+            self.__mode = mode
+        state = self.__state
+        for i in range(4):
+            bit = bool(nibble & (1 << i))
+            if bit != state[i]:
+                self.__data[i].value = bit
+                state[i] = bit
+        self.__en.on()
+        busywait(hd44780.PULSE)
+        self.__en.off()
+
+    def send(self, data, mode):
+        """send each byte in data, high nibble first"""
+        for b in data:
+            self.write4(b >> 4, mode)
+            self.write4(b, mode)
+            busywait(hd44780.DELAY)
+
+    def close(self):
+        for p in self.__data + [self.__en, self.__rs]:
+            p.close()
+        self.__data = []
+
+class hd44780i2c(object):
+    """hd44780 transport using a pcf8574 i2c backpack
+
+    Assumes the common wiring of P0 RS, P1 RW, P2 EN, P3 backlight and
+    P4-P7 D4-D7. Each byte is four port writes, enable high and low for
+    each nibble, and a run of bytes is sent in as few i2c block
+    transactions as possible. Needs the smbus module.
+    """
+
+    RS = 0x01
+    EN = 0x04
+    BACKLIGHT = 0x08
+    # bytes per smbus block transaction
+    BLOCK = 32
+
+    def __init__(self, bus=1, address=0x27):
+        import smbus
+        self.__bus = smbus.SMBus(bus)
+        self.__address = address
+
+    def write4(self, nibble, mode):
+        """clock out the low 4 bits of nibble"""
+        self.__write(self.__port(nibble, mode))
+
+    def send(self, data, mode):
+        """send each byte in data, high nibble first"""
+        ports = []
+        for b in data:
+            ports.extend(self.__port(b >> 4, mode))
+            ports.extend(self.__port(b, mode))
+        self.__write(ports)
+
+    def close(self):
+        self.__bus.close()
+
+    def __port(self, nibble, mode):
+        """return port values to clock out nibble"""
+        v = ((nibble & 0x0F) << 4) | hd44780i2c.BACKLIGHT
+        if mode:
+            v |= hd44780i2c.RS
+        return [v | hd44780i2c.EN, v]
+
+    def __write(self, ports):
+        for i in range(0, len(ports), hd44780i2c.BLOCK):
+            block = ports[i:i + hd44780i2c.BLOCK]
+            self.__bus.write_i2c_block_data(self.__address, block[0],
+                                            block[1:])
 
 class console(lcd):
-    """console output"""
+    """console output
 
-    def __init__(self, enabled=True):
+    Writes to stdout, or to the file named by output, through a block
+    buffer. format is one of OUTPUT_FORMATS.
+    """
+
+    def __init__(self, enabled=True, output=None, format='newline'):
         self.__enabled = enabled
+        if output:
+            self.__stream = open(output, 'wb', 1 << 16)
+        else:
+            self.__stream = sys.stdout
+        self.__csv = csv.writer(self.__stream, lineterminator='\n')
+        self.__format = format
 
     def write(self, line, message):
         """write message to display"""
         if self.__enabled:
-            print message
+            if self.__format == 'newline':
+                self.__stream.write(message + '\n')
+            elif self.__format == 'nul':
+                self.__stream.write(message + '\0')
+            elif self.__format == 'csv':
+                self.__csv.writerow((line, message))
+            elif self.__format == 'json':
+                self.__stream.write(json.dumps({'index':line,
+                                                'password':message}) + '\n')
+
+    def flush(self):
+        """push out any buffered output"""
+        if self.__enabled:
+            self.__stream.flush()
+
+    def close(self):
+        """clean up"""
+        self.flush()
+        if self.__stream is not sys.stdout:
+            self.__stream.close()
+        self.__enabled = False
+
+class lcdproc(lcd):
+    """display on an LCDd server
+
+    Keeps a single connection open and sets up the screen and one string
+    widget per line when it connects. write() only records the new text.
+    flush() sends all changed lines in one batch of widget_set commands
+    without waiting for replies, which a background thread reads and
+    checks. If the connection drops it is reopened by a later flush(),
+    backing off up to LCDPROC_MAX_BACKOFF seconds between attempts, and
+    the display is redrawn.
+    """
+
+    def __init__(self, enabled=True, host='127.0.0.1', port=13666):
+        self.__enabled = enabled
+        self.__host = host
+        self.__port = port
+        self.__sock = None
+        self.__rows = None
+        self.__lines = {}
+        self.__dirty = set()
+        self.__backoff = 0
+        self.__retry = 0
+        self.__lock = threading.Lock()
+        if self.__enabled:
+            self.__connect()
+
+    def write(self, line, message):
+        """write message to display
+
+        Until LCDd has said how many rows it has only the first
+        LCDPROC_DEFAULT_ROWS lines are kept, so passwords do not pile up
+        in memory while it cannot be reached.
+        """
+        if self.__enabled and line <= (self.__rows or LCDPROC_DEFAULT_ROWS):
+            self.__lines[line] = message
+            self.__dirty.add(line)
+
+    def flush(self):
+        """send changed lines to LCDd"""
+        import socket
+        if not self.__enabled or not self.__dirty:
+            return
+        if self.__sock is None and not self.__connect():
+            return
+        cmds = []
+        for line in sorted(self.__dirty):
+            if line <= self.__rows:
+                text = self.__lines[line].replace('\\', '\\\\')
+                cmds.append('widget_set pwdgen l%d 1 %d "%s"\n'
+                            % (line, line, text.replace('"', '\\"')))
+        try:
+            self.__sock.sendall(''.join(cmds))
+            self.__dirty.clear()
+        except (socket.error, AttributeError):
+            # AttributeError if the reader dropped the socket meanwhile
+            logging.warning('Lost connection to LCDd.')
+            self.__disconnect()
+
+    def close(self):
+        """clean up"""
+        self.__enabled = False
+        self.__disconnect()
+
+    def __connect(self):
+        """connect and set up the screen, return True on success"""
+        import socket
+        if time.time() < self.__retry:
+            return False
+        sock = None
+        try:
+            sock = socket.create_connection((self.__host, self.__port),
+                                            LCDPROC_TIMEOUT)
+            replies = sock.makefile('rb')
+            sock.sendall('hello\n')
+            reply = replies.readline().split()
+            if not reply or reply[0] != 'connect':
+                raise socket.error('unexpected reply to hello: %s'
+                                   % ' '.join(reply))
+            rows = int(reply[reply.index('hgt') + 1])
+            sock.sendall(''.join(['client_set -name pwdgen\n',
+                                  'screen_add pwdgen\n',
+                                  'screen_set pwdgen -priority foreground '
+                                  '-heartbeat off\n'] +
+                                 ['widget_add pwdgen l%d string\n' % r
+                                  for r in range(1, rows + 1)]))
+            sock.settimeout(None)
+        except (socket.error, ValueError, IndexError) as e:
+            if sock is not None:
+                sock.close()
+            self.__backoff = min(max(self.__backoff * 2, 1),
+                                 LCDPROC_MAX_BACKOFF)
+            self.__retry = time.time() + self.__backoff
+            logging.warning('Unable to connect to LCDd at %s:%s (%s). '
+                            'Retrying in %ds.' % (self.__host, self.__port,
+                                                  e, self.__backoff))
+            return False
+
+        logging.debug('Connected to LCDd at %s:%s, %d rows'
+                      % (self.__host, self.__port, rows))
+        with self.__lock:
+            self.__sock = sock
+        self.__rows = rows
+        self.__backoff = 0
+        # redraw everything on a new connection
+        self.__dirty = set(self.__lines)
+        reader = threading.Thread(target=self.__read, args=(sock, replies),
+                                  name='lcdproc')
+        reader.daemon = True
+        reader.start()
+        return True
+
+    def __disconnect(self, sock=None):
+        """close sock, or the current connection if None"""
+        import socket
+        with self.__lock:
+            if sock is None or sock is self.__sock:
+                sock = self.__sock
+                self.__sock = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def __read(self, sock, replies):
+        """read and check replies from LCDd until the connection closes"""
+        import socket
+        try:
+            for reply in iter(replies.readline, ''):
+                if reply.startswith('huh?'):
+                    logging.warning('LCDd: %s' % reply.strip())
+        except socket.error:
+            pass
+        if self.__enabled:
+            logging.debug('LCDd closed the connection.')
+        self.__disconnect(sock)
 
 class hidkey(lcd):
-    """simplified usb HID keyboard"""
+    """simplified usb HID keyboard
+
+    Reports are typed by a hidwriter thread so write() returns at once.
+    timeout is the default for wait(), None to wait as long as it takes.
+    """
 
     # map characters to usb hid reports
     keymap = { 'a':bytearray([0,0,0x04,0,0,0,0,0]),
@@ -293,67 +924,89 @@ class hidkey(lcd):
                  'shell':''
                 }
 
+    # key down and key up reports indexed by character code, empty for
+    # characters that cannot be typed
+    reports = [str(keymap[chr(i)] + specials['keyup']) if chr(i) in keymap
+               else '' for i in range(256)]
+    enter = str(specials['return'] + specials['keyup'])
+
     def __init__(self, device, enabled=False, launch=False, target=None, cmd=None,
-                 cmd_delay=1):
+                 cmd_delay=1, report_delay=0, timeout=None):
         self.__enabled = enabled
         self.__device = device
+        self.__timeout = timeout
         self.__launch = launch
         self.__cmd_delay = cmd_delay
+        self.__report_delay = report_delay
+        self.__writer = None
         try:
-            self.__prefix = hidkey.prefixes[target]
+            self.__prefix = str(hidkey.prefixes[target])
         except KeyError:
             # unknown target
             self.__launch = False
             self.__prefix = ''
             logging.warning('Unknow target (%s). Application launch disabled'
                             % target)
-        self.__cmd = cmd
+        self.__cmd = cmd or ''
+        self.__cmdreports = hidkey.encode(self.__cmd)
+
+    @staticmethod
+    def encode(message):
+        """return usb hid reports to type message followed by return"""
+        return (''.join(map(hidkey.reports.__getitem__, bytearray(message)))
+                + hidkey.enter)
 
     def launch(self):
         if self.__enabled and self.__launch:
             logging.debug('Sending keypresses(%s) for application launch.'
                           % (self.__prefix + self.__cmd))
-            with open(self.__device, 'w') as d:
-                d.write(self.__prefix)
-            time.sleep(self.__cmd_delay)
-            self.write(1, self.__cmd)
-            time.sleep(self.__cmd_delay)
+            self.__send(self.__prefix)
+            self.__send(float(self.__cmd_delay))
+            self.__send(self.__cmdreports)
+            self.__send(float(self.__cmd_delay))
 
     def write(self, line, message):
         """write message to display"""
         if self.__enabled:
-            try:
-                with open(self.__device, 'w') as d:
-                    for c in message:
-                        try:
-                            d.write(hidkey.keymap[c])
-                        except KeyError:
-                            pass
-                        d.write(hidkey.specials['keyup'])
-                    d.write(hidkey.specials['return'])
-                    d.write(hidkey.specials['keyup'])
-                    d.flush()
-            except KeyboardInterrupt:
-                raise
-            except:
-                logging.exception('error writing to hid keyboard')
-                self.__enabled = False
+            self.__send(hidkey.encode(message))
 
     def write_special(self, line, message):
         """write message to display"""
         if self.__enabled:
-            try:
-                with open(self.__device, 'w') as d:
-                    try:
-                        d.write(hidkey.specials[message])
-                    except KeyError:
-                        pass
-                    d.flush()
-            except KeyboardInterrupt:
-                raise
-            except:
-                logging.exception('error writing to hid keyboard')
-                self.__enabled = False
+            self.__send(str(hidkey.specials.get(message, '')))
+
+    def cancel(self):
+        """drop keypresses queued but not yet typed"""
+        if self.__writer is not None:
+            self.__writer.discard()
+
+    def wait(self, timeout=None):
+        """wait for queued keypresses to be typed, return True if they were"""
+        if timeout is None:
+            timeout = self.__timeout
+        if self.__writer is None:
+            return True
+        return self.__writer.wait(timeout)
+
+    def close(self):
+        """clean up
+
+        Waits for anything already queued to be typed.
+        """
+        if self.__writer is not None:
+            self.__writer.stop()
+            self.__writer = None
+        self.__enabled = False
+
+    def __send(self, item):
+        """queue reports, or a float delay, for the writer thread"""
+        if self.__writer is None:
+            self.__writer = hidwriter(self.__device, self.__report_delay)
+            self.__writer.start()
+        elif self.__writer.failed:
+            self.close()
+            return
+        self.__writer.send(item)
 ##
 ##    def write_prefix(self, line, message):
 ##        """write message to display"""
@@ -367,24 +1020,954 @@ class hidkey(lcd):
 ####                logging.exception('error writing to hid keyboard')
 ####                self.__enabled = False
 
+class hidwriter(threading.Thread):
+    """background writer for a usb hid gadget device
+
+    Owns the device, opened non blocking, and writes whole messages
+    queued with send() so callers never wait on the host. If the host
+    falls behind writes fail with EAGAIN and are retried once the device
+    is writable again, backing off up to HID_MAX_BACKOFF.
+
+    interval is the delay in seconds between reports. None tunes it
+    automatically: it grows each time the device pushes back and decays
+    while reports are accepted. device may be a FIFO or pty to measure
+    throughput and stalls without hardware.
+    """
+
+    def __init__(self, device, interval=0):
+        threading.Thread.__init__(self, name='hidwriter')
+        self.daemon = True
+        self.__device = device
+        self.__auto = interval is None
+        self.__interval = 0.0 if interval is None else interval
+        self.__queue = Queue.Queue()
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__idle = threading.Event()
+        self.__idle.set()
+        self.__fd = None
+        self.failed = False
+        self.reports = 0
+        self.stalls = 0
+
+    def send(self, item):
+        """queue reports to write, or a float number of seconds to pause"""
+        if not item:
+            return
+        with self.__lock:
+            self.__pending += 1
+            self.__idle.clear()
+        self.__queue.put(item)
+
+    def wait(self, timeout=None):
+        """wait for queued items to be written, return True if they were"""
+        self.__idle.wait(timeout)
+        return self.__idle.is_set()
+
+    def discard(self):
+        """drop queued items that have not been started"""
+        while True:
+            try:
+                item = self.__queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is None:
+                # stop() is waiting on this
+                self.__queue.put(None)
+                break
+            self.__done()
+
+    def stop(self):
+        """write anything still queued then stop the thread"""
+        self.__queue.put(None)
+        while self.is_alive():
+            # a timeout keeps ctrl-c working under python 2
+            self.join(1)
+
+    def run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            try:
+                if isinstance(item, float):
+                    time.sleep(item)
+                elif not self.failed:
+                    with g_stats.timer('hid_write'):
+                        self.__write(item)
+            except:
+                logging.exception('error writing to hid keyboard')
+                self.failed = True
+                self.__close()
+            finally:
+                self.__done()
+        self.__close()
+        logging.debug('HID writer sent %d reports, %d stalls, interval %.4fs'
+                      % (self.reports, self.stalls, self.__interval))
+
+    def __done(self):
+        with self.__lock:
+            self.__pending -= 1
+            if self.__pending == 0:
+                self.__idle.set()
+
+    def __write(self, data):
+        """write data, pacing reports and waiting out EAGAIN"""
+        if self.__fd is None:
+            self.__fd = os.open(self.__device, os.O_WRONLY | os.O_NONBLOCK)
+        sent = 0
+        backoff = HID_MIN_INTERVAL
+        while sent < len(data):
+            if self.__interval > 0:
+                size = HID_REPORT_SIZE
+            else:
+                size = len(data) - sent
+            try:
+                n = os.write(self.__fd, buffer(data, sent, size))
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                self.stalls += 1
+                g_stats.count('hid_stalls')
+                if self.__auto:
+                    self.__interval = min(max(self.__interval * 2,
+                                              HID_MIN_INTERVAL),
+                                          HID_MAX_INTERVAL)
+                select.select([], [self.__fd], [], backoff)
+                backoff = min(backoff * 2, HID_MAX_BACKOFF)
+                continue
+            sent += n
+            self.reports += n // HID_REPORT_SIZE
+            g_stats.count('hid_reports', n // HID_REPORT_SIZE)
+            backoff = HID_MIN_INTERVAL
+            if self.__interval > 0:
+                time.sleep(self.__interval)
+                if self.__auto:
+                    self.__interval *= HID_DECAY
+                    if self.__interval < HID_MIN_INTERVAL:
+                        self.__interval = 0.0
+
+    def __close(self):
+        if self.__fd is not None:
+            try:
+                os.close(self.__fd)
+            except OSError:
+                pass
+            self.__fd = None
+
+class bufferedrandom(random.Random):
+    """secure random numbers read from the kernel in blocks
+
+    A drop in replacement for random.SystemRandom that reads blocksize
+    bytes from os.urandom() at a time rather than making a call for
+    every few bytes. The block is held as 32 bit words which are zeroed
+    as they are handed out. Integers are drawn by rejection sampling so
+    are unbiased.
+
+    Safe to share between threads but not across fork(), the child
+    would repeat the parent's buffered words. Make a new one instead.
+    """
+
+    def __init__(self, blocksize=RNG_BLOCK_SIZE):
+        self.__blocksize = blocksize
+        self.__words = array.array('I')
+        self.__pos = 0
+        self.__lock = threading.Lock()
+        random.Random.__init__(self)
+
+    def seed(self, *args, **kwds):
+        """not used, entropy comes from the kernel"""
+        pass
+
+    def getstate(self):
+        raise NotImplementedError('bufferedrandom has no state to save.')
+
+    def setstate(self, state):
+        raise NotImplementedError('bufferedrandom has no state to restore.')
+
+    def __refill(self, n):
+        """replace the buffer with a new block of at least n words
+
+        Must be called with the lock held.
+        """
+        words = self.__words
+        # the rest of the old block is zeroed and dropped
+        words[self.__pos:] = array.array('I', [0]) * (len(words) - self.__pos)
+        self.__words = array.array('I', os.urandom(max(4 * n,
+                                                       self.__blocksize)))
+        self.__pos = 0
+
+    def __word(self):
+        """return one random 32 bit word"""
+        with self.__lock:
+            if self.__pos >= len(self.__words):
+                self.__refill(1)
+            pos = self.__pos
+            word = self.__words[pos]
+            self.__words[pos] = 0
+            self.__pos = pos + 1
+        return word
+
+    def __take(self, n):
+        """return an array of n random 32 bit words"""
+        with self.__lock:
+            if self.__pos + n > len(self.__words):
+                self.__refill(n)
+            pos = self.__pos
+            end = pos + n
+            taken = self.__words[pos:end]
+            self.__words[pos:end] = array.array('I', [0]) * n
+            self.__pos = end
+        return taken
+
+    def randbytes(self, n):
+        """return a string of n random bytes"""
+        if n >= self.__blocksize:
+            return os.urandom(n)
+        return self.__take((n + 3) // 4).tostring()[:n]
+
+    def getrandbits(self, k):
+        """return an int with k random bits"""
+        if k <= 0:
+            raise ValueError('number of bits must be greater than zero')
+        if k <= 32:
+            return int(self.__word() >> (32 - k))
+        n = (k + 31) // 32
+        x = 0
+        for w in self.__take(n):
+            x = (x << 32) | w
+        return x >> (n * 32 - k)
+
+    def random(self):
+        """return a random float in [0.0, 1.0)"""
+        a, b = self.__take(2)
+        # 53 bits, as the mersenne twister does it
+        return ((a >> 5) * 67108864.0 + (b >> 6)) * (1.0 / 9007199254740992.0)
+
+    def _randbelow(self, n):
+        """return a random int in [0, n)"""
+        if n <= 1 << 32:
+            # one word per draw, rejecting the few that would bias % n
+            limit = (1 << 32) - (1 << 32) % n
+            word = self.__word()
+            while word >= limit:
+                word = self.__word()
+            return int(word % n)
+        k = n.bit_length()
+        r = self.getrandbits(k)
+        while r >= n:
+            r = self.getrandbits(k)
+        return r
+
+    def randrange(self, start, stop=None, step=1):
+        """return a random int from range(start, stop, step)"""
+        if stop is None and type(start) is int and start > 0:
+            # the common case, randrange(n)
+            return self._randbelow(start)
+        istart = int(start)
+        if istart != start:
+            raise ValueError('non-integer arg 1 for randrange()')
+        if stop is None:
+            if istart > 0:
+                return self._randbelow(istart)
+            raise ValueError('empty range for randrange()')
+        istop = int(stop)
+        if istop != stop:
+            raise ValueError('non-integer stop for randrange()')
+        istep = int(step)
+        if istep != step:
+            raise ValueError('non-integer step for randrange()')
+        if istep > 0:
+            n = (istop - istart + istep - 1) // istep
+        elif istep < 0:
+            n = (istop - istart + istep + 1) // istep
+        else:
+            raise ValueError('zero step for randrange()')
+        if n <= 0:
+            raise ValueError('empty range for randrange()')
+        return istart + istep * self._randbelow(n)
+
+    def choice(self, seq):
+        """return a random element of seq"""
+        if not seq:
+            raise IndexError('cannot choose from an empty sequence')
+        return seq[self._randbelow(len(seq))]
+
+    def shuffle(self, x, random=None):
+        """shuffle list x in place"""
+        for i in reversed(xrange(1, len(x))):
+            j = self._randbelow(i + 1)
+            x[i], x[j] = x[j], x[i]
+
+    def sample(self, population, k):
+        """return a list of k distinct elements of population"""
+        n = len(population)
+        if not 0 <= k <= n:
+            raise ValueError('sample larger than population')
+        result = [None] * k
+        # as random.sample, a partial shuffle for small populations and
+        # redrawing repeats for large ones
+        setsize = 21
+        if k > 5:
+            setsize += 4 ** int(math.ceil(math.log(k * 3, 4)))
+        if n <= setsize:
+            pool = list(population)
+            for i in xrange(k):
+                j = self._randbelow(n - i)
+                result[i] = pool[j]
+                pool[j] = pool[n - i - 1]
+        else:
+            selected = set()
+            for i in xrange(k):
+                j = self._randbelow(n)
+                while j in selected:
+                    j = self._randbelow(n)
+                selected.add(j)
+                result[i] = population[j]
+        return result
+
+class wordindex(object):
+    """word list indexed by word length
+
+    words holds every word sorted by length. offsets[n] is the index of
+    the first word of length n so the words for any range of lengths are
+    a contiguous run and can be picked from with a single random draw.
+    len() and indexing cover the default range given by min_length and
+    max_length.
+    """
+
+    def __init__(self, words, offsets, min_length=0, max_length=None):
+        self.words = words
+        self.offsets = offsets
+        self.__start, self.__end = self.span(min_length, max_length)
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('wordindex index out of range')
+        return self.words[self.__start + i]
+
+    def span(self, min_length=None, max_length=None):
+        """return (start, end) of words with lengths in range"""
+        last = len(self.offsets) - 2
+        if min_length is None:
+            min_length = 0
+        if max_length is None:
+            max_length = last
+        min_length = min(max(min_length, 0), last + 1)
+        max_length = min(max_length, last)
+        if max_length < min_length:
+            return (0, 0)
+        return (self.offsets[min_length], self.offsets[max_length + 1])
+
+    def count(self, min_length=None, max_length=None):
+        """return number of words with lengths in range"""
+        start, end = self.span(min_length, max_length)
+        return end - start
+
+    def lengthcounts(self, min_length=None, max_length=None):
+        """return {length: number of words} for lengths in range that
+        have any words"""
+        last = len(self.offsets) - 2
+        if min_length is None:
+            min_length = 0
+        if max_length is None:
+            max_length = last
+        offsets = self.offsets
+        return dict((n, offsets[n + 1] - offsets[n])
+                    for n in xrange(max(min_length, 0),
+                                    min(max_length, last) + 1)
+                    if offsets[n + 1] > offsets[n])
+
+    def pick(self, rng, min_length=None, max_length=None):
+        """return a random word with length in range"""
+        start, end = self.span(min_length, max_length)
+        if end <= start:
+            raise ValueError('No words between %s and %s letters long.'
+                             % (min_length, max_length))
+        return self.words[start + rng.randrange(end - start)]
+
+    def sample(self, rng, count, min_length=None, max_length=None):
+        """return list of count distinct random words with length in range"""
+        start, end = self.span(min_length, max_length)
+        if count > end - start:
+            raise ValueError('Only %d words between %s and %s letters long, '
+                             '%d needed.' % (end - start, min_length,
+                                             max_length, count))
+        words = self.words
+        return [words[start + i] for i in rng.sample(xrange(end - start),
+                                                     count)]
+
+class compactwords(object):
+    """read only sequence of words packed into a single string
+
+    Holds the words joined by newlines, in one str or buffer, and an
+    array of where each starts rather than a str object per word, which
+    saves a lot of memory on large lists. Use frombuckets() to make one.
+    """
+
+    def __init__(self, packed, starts):
+        self.__buffer = packed
+        # one more than there are words, each word ends one before the
+        # next starts
+        self.__starts = starts
+
+    @classmethod
+    def frombuckets(cls, packed, counts):
+        """return compactwords for newline joined words of known lengths
+
+        counts lists (length, number of words) in the order they appear
+        in packed. Raises ValueError if they do not match packed.
+        """
+        starts = array.array('I')
+        pos = 0
+        for n, count in counts:
+            starts.extend(xrange(pos, pos + count * (n + 1), n + 1))
+            pos += count * (n + 1)
+        starts.append(pos)
+        if pos != len(packed) + 1 and (pos or len(packed)):
+            raise ValueError('Packed words do not match their lengths.')
+        return cls(packed, starts)
+
+    def packed(self):
+        """return the words joined by newlines"""
+        return self.__buffer
+
+    def __len__(self):
+        return len(self.__starts) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('compactwords index out of range')
+        return self.__buffer[self.__starts[i]:self.__starts[i + 1] - 1]
+
+    def __iter__(self):
+        b = self.__buffer
+        s = self.__starts
+        for i in xrange(len(s) - 1):
+            yield b[s[i]:s[i + 1] - 1]
+
+class uniqueset(object):
+    """set of seen items"""
+
+    def __init__(self):
+        self.__seen = set()
+
+    def add(self, item):
+        """add item, return True if it was not already present"""
+        if item in self.__seen:
+            return False
+        self.__seen.add(item)
+        return True
+
+class bloomfilter(object):
+    """probabilistic set of seen items in a fixed amount of memory
+
+    add() may report an item as already present when it is not, with
+    probability error_rate once capacity items have been added. It never
+    reports a repeated item as new.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.__size = int(math.ceil(-capacity * math.log(error_rate)
+                                    / math.log(2) ** 2))
+        self.__hashes = max(1, int(round(self.__size / float(capacity)
+                                         * math.log(2))))
+        self.__bits = bytearray((self.__size + 7) // 8)
+
+    def add(self, item):
+        """add item, return True if it was not already present"""
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        bits = self.__bits
+        new = False
+        for i in xrange(self.__hashes):
+            b = (h1 + i * h2) % self.__size
+            if not bits[b >> 3] & (1 << (b & 7)):
+                bits[b >> 3] |= 1 << (b & 7)
+                new = True
+        return new
+
+class pwdtemplate(object):
+    """compiled password template
+
+    spec describes the layout of a password: W is a word, S a seperator
+    and D a digit, e.g. 'DD W S W S W DD'. Spaces are ignored. Any other
+    character, or a placeholder escaped with a backslash, is used as is.
+    Words are distinct and between min_length and max_length letters
+    long. mangle is applied to each password, see compilemangler().
+
+    If total_min or total_max are set passwords are also limited to that
+    many characters in all. Word lengths are drawn from a lengthplan so
+    each password in range is equally likely and none are thrown away
+    for being the wrong length.
+    """
+
+    def __init__(self, spec, seperators='', min_length=None, max_length=None,
+                 mangle=None, total_min=None, total_max=None):
+        self.spec = spec
+        self.seperators = seperators
+        self.min_length = min_length
+        self.max_length = max_length
+        self.total_min = total_min
+        self.total_max = total_max
+        self.mangle = mangle
+        # (wordlist, lengthplan) for the last wordlist used
+        self.__plan = None
+
+        # parse into (kind, value) parts, merging runs of digits and literals
+        self.parts = []
+        escaped = False
+        for c in spec:
+            if escaped:
+                part = ('literal', c)
+                escaped = False
+            elif c == '\\':
+                escaped = True
+                continue
+            elif c.isspace():
+                continue
+            elif c == 'W':
+                part = ('word', None)
+            elif c == 'S':
+                part = ('sep', None)
+            elif c == 'D':
+                part = ('digits', 1)
+            else:
+                part = ('literal', c)
+            if (part[0] in ('literal', 'digits') and self.parts
+                and self.parts[-1][0] == part[0]):
+                self.parts[-1] = (part[0], self.parts[-1][1] + part[1])
+            else:
+                self.parts.append(part)
+        if escaped:
+            raise ValueError('Password template ends with an escape.')
+
+        # precompute where each random piece goes
+        self.__pieces = []
+        self.__wordpos = []
+        self.__seppos = []
+        self.__digitpos = []
+        for pos, (kind, value) in enumerate(self.parts):
+            self.__pieces.append(value if kind == 'literal' else '')
+            if kind == 'word':
+                self.__wordpos.append(pos)
+            elif kind == 'sep':
+                self.__seppos.append(pos)
+            elif kind == 'digits':
+                self.__digitpos.append((pos, value, 10 ** value))
+        self.words = len(self.__wordpos)
+        # characters not taken up by words, mangling keeps lengths
+        self.fixed_length = sum(len(value) if kind == 'literal'
+                                else value if kind == 'digits'
+                                else 1 if kind == 'sep' else 0
+                                for kind, value in self.parts)
+        self.lengthlimited = total_min is not None or total_max is not None
+        if self.__seppos and not seperators:
+            raise ValueError('Password template needs a seperator but none '
+                             'are configured.')
+
+    def plan(self, wordlist):
+        """return the lengthplan for wordlist, None if length is not limited
+
+        Raises ValueError if no password can be in range.
+        """
+        if not self.lengthlimited:
+            return None
+        cached = self.__plan
+        if cached is not None and cached[0] is wordlist:
+            return cached[1]
+        counts = wordlist.lengthcounts(self.min_length, self.max_length)
+        low = (self.total_min or 0) - self.fixed_length
+        if self.total_max is None:
+            high = self.words * max(counts or [0])
+        else:
+            high = self.total_max - self.fixed_length
+        plan = lengthplan(counts, self.words, low, high)
+        if not plan.count:
+            raise ValueError('No passwords of %s characters can be made '
+                             'from %s.' % (self.__lengthrange(), self.spec))
+        self.__plan = (wordlist, plan)
+        return plan
+
+    def generate(self, wordlist, rng):
+        """return a random password"""
+        out = list(self.__pieces)
+        if self.lengthlimited:
+            words = self.__lengthwords(wordlist, rng)
+        elif self.words:
+            words = wordlist.sample(rng, self.words, self.min_length,
+                                    self.max_length)
+        else:
+            words = ()
+        for pos, w in zip(self.__wordpos, words):
+            out[pos] = w
+        if self.__seppos:
+            sep = self.seperators
+            n = len(sep)
+            for pos in self.__seppos:
+                out[pos] = sep[rng.randrange(n)]
+        for pos, width, limit in self.__digitpos:
+            out[pos] = '%0*d' % (width, rng.randrange(limit))
+        if self.mangle is None:
+            return ''.join(out)
+        return self.mangle(''.join(out), rng)
+
+    def __lengthwords(self, wordlist, rng):
+        """return distinct words with lengths from the lengthplan
+
+        Word lengths are drawn first, then a word of each length. Draws
+        that repeat a word are thrown away whole, which keeps the
+        result uniform over passwords without repeats.
+        """
+        plan = self.plan(wordlist)
+        for i in xrange(LENGTH_MAX_REDRAWS):
+            words = [wordlist.pick(rng, n, n) for n in plan.sample(rng)]
+            if len(set(words)) == len(words):
+                return words
+        raise ValueError('Too few words to make passwords of %s characters '
+                         'without repeating a word.' % self.__lengthrange())
+
+    def __lengthrange(self):
+        """describe the total length limits, for error messages"""
+        if self.total_min is None:
+            return 'at most %d' % self.total_max
+        if self.total_max is None:
+            return 'at least %d' % self.total_min
+        return 'between %d and %d' % (self.total_min, self.total_max)
+
+class lengthplan(object):
+    """word length combinations with a total in range
+
+    counts maps each word length to the number of words that long. For
+    passwords of words words, ways[i][t] is the number of ways words i
+    onwards can add up to t letters, counting each choice of word. Drawing
+    lengths in proportion to these counts makes every password with
+    between min_total and max_total letters of words equally likely.
+    count is the number of such passwords, allowing repeated words.
+    """
+
+    def __init__(self, counts, words, min_total, max_total):
+        self.counts = sorted(counts.items())
+        self.words = words
+        size = max(max_total + 1, 0)
+        ways = [[0] * size for i in xrange(words + 1)]
+        if size:
+            ways[words][0] = 1
+        for i in xrange(words - 1, -1, -1):
+            later = ways[i + 1]
+            for t in xrange(size):
+                ways[i][t] = sum(c * later[t - n] for n, c in self.counts
+                                 if n <= t)
+        self.ways = ways
+        self.totals = [(t, ways[0][t])
+                       for t in xrange(max(min_total, 0), size) if ways[0][t]]
+        self.count = sum(n for t, n in self.totals)
+
+    def sample(self, rng):
+        """return a list of word lengths"""
+        t = weightedchoice(rng, self.totals, self.count)
+        lengths = []
+        for i in xrange(self.words):
+            later = self.ways[i + 1]
+            n = weightedchoice(rng, [(n, c * later[t - n])
+                                     for n, c in self.counts if n <= t],
+                               self.ways[i][t])
+            lengths.append(n)
+            t -= n
+        return lengths
+
+class devicequeue(lcd):
+    """runs an output device in its own worker thread
+
+    Calls are queued for the worker so a slow device does not hold up the
+    others. The queue holds at most maxsize calls. When it is full,
+    callers wait up to timeout seconds, then the call is dropped.
+    timeout is also the default for wait().
+    """
+
+    def __init__(self, device, maxsize=DEVICE_QUEUE_SIZE, timeout=None):
+        self.device = device
+        self.__timeout = timeout
+        self.__queue = Queue.Queue(maxsize)
+        self.__lock = threading.Lock()
+        self.__pending = 0
+        self.__idle = threading.Event()
+        self.__idle.set()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name=devicename(device))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def reset(self):
+        self.__put(self.device.reset)
+
+    def launch(self):
+        self.__put(self.device.launch)
+
+    def write(self, line, message):
+        """write message to display"""
+        self.__put(self.device.write, line, message)
+
+    def flush(self):
+        """push out any buffered output"""
+        self.__put(self.device.flush)
+
+    def wait(self, timeout=None):
+        """wait for queued calls and the device to finish, True if they did
+
+        Devices such as hidkey carry on writing after their calls return
+        so the device is waited on too, within the same timeout.
+        """
+        if timeout is None:
+            timeout = self.__timeout
+        start = time.time()
+        self.__idle.wait(timeout)
+        if not self.__idle.is_set():
+            return False
+        if timeout is not None:
+            timeout = max(timeout - (time.time() - start), 0)
+        return self.device.wait(timeout)
+
+    def cancel(self):
+        """drop queued calls and the device's own queued output"""
+        while True:
+            try:
+                call = self.__queue.get_nowait()
+            except Queue.Empty:
+                break
+            if call is None:
+                # close() is waiting on this
+                self.__queue.put(None)
+                break
+            self.__done()
+        self.device.cancel()
+
+    def close(self):
+        """finish queued calls then clean up"""
+        self.__queue.put(None)
+        while self.__thread.is_alive():
+            # a timeout keeps ctrl-c working under python 2
+            self.__thread.join(1)
+        self.device.close()
+
+    def __put(self, func, *args):
+        with self.__lock:
+            self.__pending += 1
+            self.__idle.clear()
+        try:
+            self.__queue.put((func, args), True, self.__timeout)
+        except Queue.Full:
+            logging.warning('%s is not keeping up, output dropped.'
+                            % devicename(self.device))
+            self.__done()
+
+    def __done(self):
+        with self.__lock:
+            self.__pending -= 1
+            if self.__pending == 0:
+                self.__idle.set()
+
+    def __run(self):
+        while True:
+            call = self.__queue.get()
+            if call is None:
+                break
+            try:
+                call[0](*call[1])
+            except:
+                logging.exception('error writing to %s'
+                                  % devicename(self.device))
+            finally:
+                self.__done()
+
+class passwordpool(object):
+    """sets of passwords generated ahead of time
+
+    A background thread keeps up to depth sets of passwords ready so
+    taking one never waits on generation, unless the pool has run dry.
+    Sets are only held in memory and each is handed out once.
+    """
+
+    def __init__(self, wordlist, rng, cfg, depth):
+        self.__wordlist = wordlist
+        self.__rng = rng
+        self.__cfg = cfg
+        self.__queue = Queue.Queue(depth)
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='passwordpool')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def get(self):
+        """return the next set of passwords"""
+        try:
+            return self.__queue.get_nowait()
+        except Queue.Empty:
+            logging.debug('Password pool empty, waiting.')
+            # a timeout, in case stop() is called while waiting
+            while self.__thread.is_alive():
+                try:
+                    return self.__queue.get(True, 1)
+                except Queue.Empty:
+                    pass
+            return genpasswords(self.__wordlist, self.__rng, self.__cfg)
+
+    def stop(self):
+        """stop the background thread and discard the pool"""
+        self.__stop.set()
+        # make room in case the thread is waiting to add a set
+        try:
+            self.__queue.get_nowait()
+        except Queue.Empty:
+            pass
+        self.__thread.join(1)
+        while True:
+            try:
+                self.__queue.get_nowait()
+            except Queue.Empty:
+                break
+
+    def __run(self):
+        try:
+            while not self.__stop.is_set():
+                # blocks while the pool is full
+                self.__queue.put(genpasswords(self.__wordlist, self.__rng,
+                                              self.__cfg))
+        except:
+            logging.exception('Password pool stopped.')
+
+class pwdserver(object):
+    """serves passwords over a unix domain socket
+
+    Keeps the wordlist loaded so each request only costs a round trip.
+    Each request is one line, either empty for the configured defaults, a
+    number of passwords, or a json object whose fields override the
+    config as listed in SERVE_OVERRIDES, within the SERVE_MAX limits,
+    plus unique. Each reply is a
+    line of json, {"passwords": [...]} or {"error": "..."}. A connection
+    may make any number of requests.
+    """
+
+    def __init__(self, path, wordlist, rng, cfg):
+        import socket
+        import SocketServer
+
+        self.wordlist = wordlist
+        self.rng = rng
+        self.cfg = cfg
+        self.path = path
+        makesocketdir(path)
+        if os.path.lexists(path):
+            # remove a stale socket of ours, unless a server is still
+            # using it. Anything else is left alone.
+            checksocket(path)
+            try:
+                requestpasswords(path, {'count':0})
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise socket.error('pwdgen already serving on %s' % path)
+
+        server = self
+        class handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                server.handle(self.rfile, self.wfile)
+        class unixserver(SocketServer.ThreadingMixIn,
+                         SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        # passwords are served so only the owner may connect
+        umask = os.umask(0177)
+        try:
+            self.__server = unixserver(path, handler)
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self):
+        self.__server.serve_forever()
+
+    def shutdown(self):
+        self.__server.shutdown()
+
+    def server_close(self):
+        self.__server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def handle(self, rfile, wfile):
+        """answer requests on one connection until it is closed"""
+        for line in iter(rfile.readline, ''):
+            g_stats.count('requests')
+            try:
+                cfg, unique = requestconfig(self.cfg, line)
+                passwords = igenpasswords(self.wordlist, self.rng, cfg,
+                                          unique=unique)
+                reply = {'passwords':list(timediter('genpasswords',
+                                                    passwords))}
+            except ValueError as e:
+                reply = {'error':str(e)}
+            wfile.write(json.dumps(reply) + '\n')
+
 class cmdbutton(object):
+    """push button that sends a set of passwords to the devices
 
-    def __init__(self, cfg, lcds, wordlist, rng):
-        
-        self.__button = gpiozero.Button(cfg['button_pin'], pull_up=True,
-##                                        bounce_time=0.001,
-                                        hold_time=3)
+    gpiozero callbacks only record presses. The work is done by a
+    worker thread so callbacks, and long press shutdown, are never held
+    up by output. Presses made while output is running cancel it and
+    are merged into a single new set of passwords.
+
+    loadconfig, if given, returns a freshly read config. It is used by
+    reload() to pick up changes to the [password] section, and the
+    dictionary, while running.
+    """
+
+    def __init__(self, cfg, lcds, wordlist, rng, loadconfig=None):
+        import gpiozero
+
+        # not gpiozero.Button, whose hold thread polls ten times a second
+        # even when nothing is pressed. Long presses are timed by
+        # __holdtimer, which only runs while the button is down.
+        self.__button = gpiozero.DigitalInputDevice(cfg['button_pin'],
+##                                                    bounce_time=0.001,
+                                                    pull_up=True)
         self.__press_time = None
+        self.__holdtimer = None
 
-        self.__button.when_held = self.__on_hold
-        self.__button.when_pressed = self.__on_press
-        self.__button.when_released = self.__on_release
+        self.__button.when_activated = self.__on_press
+        self.__button.when_deactivated = self.__on_release
 
-        self.__cfg = cfg
         self.__lcds = lcds
-        self.__wordlist = wordlist
-        self.__rng = rng
-        self.__groundpin = self.__cfg['button_ground']
+        self.__loadconfig = loadconfig
+        # (config, wordlist, wordlist key, rng, pool) replaced as a whole
+        # by reload so a press always sees a consistent set
+        self.__state = (cfg, wordlist, wordlistkey(cfg), rng,
+                        self.__makepool(cfg, wordlist, rng))
+        # config as last read, to tell which sections were edited since
+        self.__readcfg = cfg
+        self.__reloadlock = threading.Lock()
+        self.__reloadwanted = False
+        self.__reloader = None
+        # guards the press state below and wakes the worker
+        self.__work = threading.Condition()
+        # release time of the newest press not yet started, or None
+        self.__pending = None
+        # cancel event of the output in progress, or None
+        self.__cancel = None
+        self.__stopping = False
+        self.__worker = threading.Thread(target=self.__runpresses,
+                                         name='presses')
+        self.__worker.daemon = True
+        self.__worker.start()
+        self.__groundpin = cfg['button_ground']
         if self.__groundpin != -1:
             # this is to allow the use of an arbitrary gpio as
             # ground for the button
@@ -394,39 +1977,486 @@ class cmdbutton(object):
             self.__ground = None
 
     def run(self):
-        while g_run_threads:
-            time.sleep(0.1)
+        """wait for button presses until shutdown is requested
+
+        Must be called from the main thread after handlesignals(). It
+        blocks until woken by a signal or requestshutdown() so there are
+        no wake ups while idle. SIGHUP, via onreload(), starts a reload.
+        """
+        while not g_shutdown.is_set():
+            waitforwakeup()
+            if g_reload.is_set() and not g_shutdown.is_set():
+                g_reload.clear()
+                self.reload()
         self.__button.close()
+        if self.__holdtimer is not None:
+            self.__holdtimer.cancel()
+        with self.__work:
+            self.__stopping = True
+            self.__cancelpress()
+            self.__work.notify()
+        while self.__worker.is_alive():
+            # a timeout keeps ctrl-c working under python 2
+            self.__worker.join(1)
+        pool = self.__state[4]
+        if pool is not None:
+            pool.stop()
         try:
             self.__ground.close()
         except:
             pass
-    
+
+    def reload(self):
+        """reload config and wordlist in a background thread
+
+        Presses carry on with the current settings until the new ones
+        are ready. A reload asked for while one is running is done again
+        once it finishes.
+        """
+        if self.__loadconfig is None:
+            return
+        with self.__reloadlock:
+            self.__reloadwanted = True
+            if self.__reloader is None:
+                self.__reloader = threading.Thread(target=self.__reloadloop,
+                                                   name='reload')
+                self.__reloader.daemon = True
+                self.__reloader.start()
+
+    def __reloadloop(self):
+        while True:
+            with self.__reloadlock:
+                if not self.__reloadwanted:
+                    self.__reloader = None
+                    return
+                self.__reloadwanted = False
+            try:
+                with g_stats.timer('reload'):
+                    self.__reload()
+            except (SystemExit, Exception) as e:
+                # SystemExit from getconfig() on an unreadable file
+                logging.warning('Reload failed, keeping current settings '
+                                '(%s)' % e)
+
+    def __reload(self):
+        """build the new state off to the side then swap it in"""
+        cfg, wordlist, key, rng, pool = self.__state
+        new = self.__loadconfig()
+        # only warn about each edit once, the config in use keeps the
+        # old values for sections other than [password]
+        for section in sorted(changedsections(self.__readcfg, new)
+                              - set(['password'])):
+            logging.warning('Changes to [%s] need a restart to take effect.'
+                            % section)
+        self.__readcfg = new
+        changed = changedsections(cfg, new)
+        newkey = wordlistkey(new)
+        if 'password' not in changed and newkey == key:
+            logging.info('Reload: no password settings changed.')
+            return
+        # only the [password] section is taken from the new config
+        newcfg = dict(cfg)
+        for k, v in new.iteritems():
+            if k.startswith('pwd_'):
+                newcfg[k] = v
+        checkconfig(newcfg)
+        if newkey != key:
+            logging.info('Reload: loading wordlist %s' % newcfg['pwd_dict'])
+            newlist = loadwordlist(newcfg['pwd_dict'],
+                                   newcfg['pwd_minlength'],
+                                   newcfg['pwd_maxlength'],
+                                   newcfg['pwd_cachedir'],
+                                   newcfg['pwd_compact'])
+        elif (newcfg['pwd_minlength'], newcfg['pwd_maxlength']) != \
+             (cfg['pwd_minlength'], cfg['pwd_maxlength']):
+            # every length is loaded, only the default range moves
+            newlist = wordindex(wordlist.words, wordlist.offsets,
+                                newcfg['pwd_minlength'],
+                                newcfg['pwd_maxlength'])
+        else:
+            newlist = wordlist
+        if newcfg['pwd_rng'] != cfg['pwd_rng']:
+            rng = getrng(newcfg['pwd_rng'])
+        template = compiletemplate(newcfg)
+        available = newlist.count(newcfg['pwd_minlength'],
+                                  newcfg['pwd_maxlength'])
+        if available < template.words:
+            raise ValueError('Only %d words between %d and %d letters long, '
+                             '%d needed.' % (available,
+                                             newcfg['pwd_minlength'],
+                                             newcfg['pwd_maxlength'],
+                                             template.words))
+        template.plan(newlist)
+        self.__state = (newcfg, newlist, newkey, rng,
+                        self.__makepool(newcfg, newlist, rng))
+        if pool is not None:
+            pool.stop()
+        g_stats.count('reloads')
+        logging.info('Reload: done.')
+
+    def __makepool(self, cfg, wordlist, rng):
+        if cfg['button_pooldepth'] > 0:
+            return passwordpool(wordlist, rng, cfg,
+                                cfg['button_pooldepth'])
+        return None
+
     def __on_press(self):
         # button pressed
 ##        self.__press_time = time.time() - self.__button.active_time
         self.__press_time = time.time()
         logging.debug('Pressed at %s' % self.__press_time)
+        self.__holdtimer = threading.Timer(BUTTON_HOLD_TIME, self.__on_hold)
+        self.__holdtimer.daemon = True
+        self.__holdtimer.start()
 
     def __on_release(self):
         release_time = time.time()
+        if self.__holdtimer is not None:
+            self.__holdtimer.cancel()
+            self.__holdtimer = None
         pressed_for = release_time - self.__press_time
         logging.debug('Released at %s after %s' % (release_time, pressed_for))
         if pressed_for < 2.0:
             # short press
-            outputpasswords(genpasswords(self.__wordlist, self.__rng, self.__cfg),
-                            self.__lcds)
+            g_stats.count('presses')
+            with self.__work:
+                if self.__pending is not None:
+                    g_stats.count('presses_merged')
+                self.__pending = release_time
+                self.__cancelpress()
+                self.__work.notify()
+
+    def __cancelpress(self):
+        """cancel the output in progress, with self.__work held"""
+        if self.__cancel is not None and not self.__cancel.is_set():
+            self.__cancel.set()
+            for l in self.__lcds:
+                l.cancel()
+            g_stats.count('outputs_cancelled')
+
+    def __runpresses(self):
+        """worker thread, writes a set of passwords for each press"""
+        while True:
+            with self.__work:
+                while self.__pending is None and not self.__stopping:
+                    # no timeout, which would poll under python 2
+                    self.__work.wait()
+                if self.__stopping:
+                    return
+                released = self.__pending
+                self.__pending = None
+                cancel = self.__cancel = threading.Event()
+            try:
+                self.__press(released, cancel)
+            except:
+                logging.exception('Error handling button press.')
+            finally:
+                with self.__work:
+                    self.__cancel = None
+
+    def __press(self, released, cancel):
+        """write a set of passwords for a press released at released"""
+        g_stats.observe('press_wait', time.time() - released)
+        cfg, wordlist, key, rng, pool = self.__state
+        with g_stats.timer('press'):
+            if pool is not None:
+                passwords = pool.get()
+            else:
+                passwords = genpasswords(wordlist, rng, cfg)
+            # press to first output, the latency the user sees
+            first = lambda: g_stats.observe('press_latency',
+                                            time.time() - released)
+            # returns once the devices are idle, hid typing included, so
+            # presses until then merge into the next set or cancel this one
+            outputpasswords(onfirst(passwords, first), self.__lcds,
+                            cancel=cancel)
 
     def __on_hold(self):
         # button held
+        with self.__work:
+            self.__cancelpress()
         if _DEBUG:
             os.system('echo SUDO POWEROFF')
         else:
             os.system('sudo poweroff')
-            sys.exit(0)
+            requestshutdown()
 
 
 ## functions
+def calibrateclock():
+    """measure the cost of reading the clock, for busywait()"""
+    global g_clock_overhead
+    if g_clock_overhead is None:
+        n = 1000
+        start = time.time()
+        for i in xrange(n):
+            time.time()
+        g_clock_overhead = (time.time() - start) / n
+
+def busywait(seconds):
+    """wait for seconds by spinning rather than sleeping
+
+    For delays of microseconds, which time.sleep() would overshoot.
+    """
+    end = time.time() + seconds - (g_clock_overhead or 0)
+    while time.time() < end:
+        pass
+
+def handlesignals(hup=None):
+    """exit cleanly on SIGTERM, SIGINT and SIGHUP
+
+    hup, if given, handles SIGHUP instead. Signals are also written to a
+    pipe, read by waitforwakeup(), so one arriving just before the main
+    loop blocks is not missed.
+    """
+    global g_wakeup
+    g_wakeup = os.pipe()
+    for fd in g_wakeup:
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(g_wakeup[1])
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, onsignal)
+    if hup is not None:
+        signal.signal(signal.SIGHUP, hup)
+
+def onsignal(signum, frame):
+    """signal handler, ask the main loop to exit"""
+    logging.debug('Received signal %d, shutting down.' % signum)
+    g_shutdown.set()
+
+def onreload(signum, frame):
+    """SIGHUP handler for button mode, ask the main loop to reload"""
+    logging.debug('Received signal %d, reloading.' % signum)
+    g_reload.set()
+
+def requestshutdown():
+    """ask the main loop to exit, from any thread"""
+    g_shutdown.set()
+    wakeup()
+
+def wakeup():
+    """wake the main loop from waitforwakeup(), from any thread"""
+    if g_wakeup is not None:
+        try:
+            os.write(g_wakeup[1], '\0')
+        except OSError:
+            # pipe full, already due to wake
+            pass
+
+def waitforwakeup():
+    """block until a signal or wakeup() call"""
+    try:
+        select.select([g_wakeup[0]], [], [])
+        os.read(g_wakeup[0], 512)
+    except (select.error, OSError) as e:
+        if e.args[0] not in (errno.EINTR, errno.EAGAIN):
+            raise
+
+def devicename(device):
+    """return the class name of device, looking through any wrappers"""
+    while hasattr(device, 'device'):
+        device = device.device
+    return device.__class__.__name__
+
+def devicetimeout(device, cfg):
+    """return how long device may take to finish output, None for no limit"""
+    name = devicename(device)
+    if name == 'hidkey':
+        return cfg['hidkey_timeout']
+    if name in ('hd44780', 'lcdproc'):
+        return cfg['lcd_timeout']
+    return None
+
+def timed(name):
+    """decorator timing each call of a function into g_stats"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with g_stats.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def timediter(name, iterable):
+    """yield from iterable, recording the total time taken to produce it"""
+    spent = 0.0
+    iterable = iter(iterable)
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(iterable)
+            finally:
+                spent += time.time() - start
+            yield item
+    except StopIteration:
+        pass
+    finally:
+        g_stats.observe(name, spent)
+
+def weightedchoice(rng, choices, total):
+    """return a value from (value, weight) choices, weights summing to total"""
+    r = rng.randrange(total)
+    for value, weight in choices:
+        if r < weight:
+            return value
+        r -= weight
+    raise ValueError('weights add up to less than %s' % total)
+
+def markstartup(stage):
+    """record the time stage of startup was reached, for --profile-startup"""
+    g_startup.append((stage, time.time()))
+
+def onfirst(iterable, func):
+    """yield from iterable, calling func when the first item is taken"""
+    iterable = iter(iterable)
+    for item in iterable:
+        func()
+        yield item
+        break
+    for item in iterable:
+        yield item
+
+def reportstartup(out=sys.stderr):
+    """write the time taken by each recorded startup stage to out"""
+    start = last = g_startup[0][1]
+    for stage, t in g_startup[1:]:
+        out.write('%-14s %8.2fms %8.2fms\n'
+                  % (stage, (t - last) * 1000, (t - start) * 1000))
+        last = t
+
+def requestconfig(cfg, line):
+    """return (config, unique) for a pwdserver request line
+
+    Raises ValueError if the request is not valid.
+    """
+    line = line.strip()
+    if not line:
+        request = {}
+    elif line.isdigit():
+        request = {'count':int(line)}
+    else:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError('Request must be a json object.')
+    limits = {'count':SERVE_MAX_COUNT,
+              'words':SERVE_MAX_WORDS,
+              'prefix_digits':SERVE_MAX_DIGITS,
+              'suffix_digits':SERVE_MAX_DIGITS}
+    cfg = dict(cfg)
+    for key, value in request.iteritems():
+        if key == 'unique':
+            if not isinstance(value, bool):
+                raise ValueError('unique must be true or false.')
+            continue
+        if key not in SERVE_OVERRIDES:
+            raise ValueError('Unknown request field: %s' % key)
+        if key in ('case', 'seperator', 'template'):
+            if not isinstance(value, basestring):
+                raise ValueError('%s must be a string.' % key)
+            value = str(value)
+            if len(value) > SERVE_MAX_LENGTH:
+                raise ValueError('%s may be at most %d characters.'
+                                 % (key, SERVE_MAX_LENGTH))
+        elif key == 'leet':
+            if not isinstance(value, bool):
+                raise ValueError('leet must be true or false.')
+        elif (isinstance(value, bool) or not isinstance(value, (int, long))
+              or value < 0):
+            raise ValueError('%s must be a whole number.' % key)
+        elif value > limits.get(key, SERVE_MAX_LENGTH):
+            raise ValueError('%s may be at most %d.'
+                             % (key, limits.get(key, SERVE_MAX_LENGTH)))
+        cfg[SERVE_OVERRIDES[key]] = value
+    if cfg['pwd_case'] not in CASES:
+        raise ValueError('case must be one of %s.' % ', '.join(CASES))
+    if cfg['pwd_generate'] > SERVE_MAX_COUNT:
+        raise ValueError('At most %d passwords per request.' % SERVE_MAX_COUNT)
+    checkconfig(cfg)
+    # checks the template and seperators
+    template = compiletemplate(cfg)
+    if template.words > SERVE_MAX_WORDS:
+        raise ValueError('At most %d words per password.' % SERVE_MAX_WORDS)
+    return cfg, request.get('unique', False)
+
+def requestpasswords(path, request):
+    """ask the pwdserver at path for passwords, return them as a list
+
+    request is a dict of fields as described in pwdserver. Raises
+    socket.error if the server cannot be reached and ValueError if it
+    rejects the request.
+    """
+    import socket
+    # never hand a request, or trust a reply, to someone else's socket
+    checksocket(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + '\n')
+        reply = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not reply:
+        raise socket.error('pwdgen server closed the connection')
+    reply = json.loads(reply)
+    if 'error' in reply:
+        raise ValueError(reply['error'])
+    return [str(p) for p in reply['passwords']]
+
+def defaultsocket():
+    """return the default pwdserver socket path
+
+    In $XDG_RUNTIME_DIR, which only the user can reach, if set, otherwise
+    in a pwdgen-<uid> directory of the temporary directory that
+    makesocketdir() creates private to the user.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and os.path.isdir(runtime):
+        return os.path.join(runtime, 'pwdgen.sock')
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), 'pwdgen-%d' % os.getuid(),
+                        'pwdgen.sock')
+
+def makesocketdir(path):
+    """create the directory for socket path if needed and check it is safe
+
+    A missing directory is created readable only by the user. Raises
+    socket.error if the directory belongs to another user, or others
+    may replace files in it.
+    """
+    import socket
+    parent = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(parent, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise socket.error(e.errno, '%s (%s)' % (e.strerror, parent))
+    st = os.lstat(parent)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid not in (0, os.getuid()):
+        raise socket.error('%s is not a directory of ours' % parent)
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and \
+       not st.st_mode & stat.S_ISVTX:
+        raise socket.error('%s may be written by other users' % parent)
+
+def checksocket(path):
+    """raise socket.error unless path is a socket owned by the user"""
+    import socket
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        raise socket.error(e.errno, e.strerror)
+    if not stat.S_ISSOCK(st.st_mode):
+        raise socket.error('%s is not a socket' % path)
+    if st.st_uid != os.getuid():
+        raise socket.error('%s belongs to another user' % path)
+
+def getrng(backend='buffered'):
+    """return the random number generator for backend, see RNG_BACKENDS"""
+    if backend == 'system':
+        return random.SystemRandom()
+    return bufferedrandom()
+
 def getconfig(configfile='pwdgen.cfg'):
     """Get config from file"""
 
@@ -434,34 +2464,51 @@ def getconfig(configfile='pwdgen.cfg'):
 ##    button_enabled
 ##    button_ground
 ##    button_pin
+##    button_pooldepth
+##    daemon_socket
 ##    hdd44780_cols
 ##    hdd44780_d4
 ##    hdd44780_d5
 ##    hdd44780_d6
 ##    hdd44780_d7
 ##    hdd44780_en
+##    hdd44780_i2caddress
+##    hdd44780_i2cbus
+##    hdd44780_interface
 ##    hdd44780_rows
 ##    hdd44780_rs
 ##    hidkey_device
 ##    hidkey_enabled
 ##    hidkey_launch
+##    hidkey_reportdelay
 ##    hidkey_target
+##    hidkey_timeout
 ##    hidkey_cmd
 ##    hidkey_cmddelay
 ##    lcd_enabled
+##    lcd_timeout
 ##    lcd_type
 ##    lcdproc_host
 ##    lcdproc_port
+##    pwd_cachedir
 ##    pwd_case
+##    pwd_compact
 ##    pwd_dict
 ##    pwd_generate
 ##    pwd_leet
 ##    pwd_maxlength
 ##    pwd_minlength
 ##    pwd_prefixd
+##    pwd_rng
 ##    pwd_seperator
 ##    pwd_suffixd
+##    pwd_template
+##    pwd_totalmax
+##    pwd_totalmin
 ##    pwd_words
+##    stats_file
+##    stats_format
+##    stats_interval
 
     # default values
     defaults = {'dict':'/usr/share/dict/words',
@@ -474,6 +2521,12 @@ def getconfig(configfile='pwdgen.cfg'):
                 'prefix_digits':'0',
                 'suffix_digits':'0',
                 'case':'lower',
+                'cache_dir':'~/.cache/pwdgen',
+                'compact':'no',
+                'rng':'buffered',
+                'total_min':'',
+                'total_max':'',
+                'template':'',
 
                 'enabled':'no',
 
@@ -481,8 +2534,20 @@ def getconfig(configfile='pwdgen.cfg'):
                 'port':'13666',
                 
                 'ground_pin':'-1',
+                'pool_depth':'2',
+
+                'socket':'',
+
+                'file':'',
+                'format':'json',
+                'interval':'60',
+
+                'interface':'gpio',
+                'i2c_bus':'1',
+                'i2c_address':'0x27',
 
                 'cmd_delay':'1',
+                'report_delay':'0',
                 'target':'',
                 'windows_cmd':'',
                 'pixel_cmd':'',
@@ -513,6 +2578,16 @@ def getconfig(configfile='pwdgen.cfg'):
     config['pwd_prefixd'] = cp.getint('password', 'prefix_digits')
     config['pwd_suffixd'] = cp.getint('password', 'suffix_digits')
     config['pwd_case'] = cp.get('password', 'case')
+    config['pwd_template'] = cp.get('password', 'template', raw=True).strip()
+    config['pwd_cachedir'] = os.path.expanduser(cp.get('password', 'cache_dir'))
+    config['pwd_compact'] = cp.getboolean('password', 'compact')
+    for key in ('total_min', 'total_max'):
+        value = cp.get('password', key).strip()
+        config['pwd_' + key.replace('_', '')] = int(value) if value else None
+    config['pwd_rng'] = cp.get('password', 'rng').lower()
+    if config['pwd_rng'] not in RNG_BACKENDS:
+        logging.warning('Invalid rng (%s) specified. Using buffered.' % config['pwd_rng'])
+        config['pwd_rng'] = 'buffered'
 
     # lcd section
     try:
@@ -526,6 +2601,9 @@ def getconfig(configfile='pwdgen.cfg'):
         logging.warning("Unabled to read lcd config")
         config['lcd_enabled'] = False
 
+    # optional, so a missing value leaves the rest of [lcd] alone
+    config['lcd_timeout'] = getseconds(cp, 'lcd', 'timeout')
+
     # lcd config
     if config['lcd_enabled']:
         if config['lcd_type'] == 'hd44780':
@@ -533,12 +2611,17 @@ def getconfig(configfile='pwdgen.cfg'):
             try:
                 config['hdd44780_rows'] = cp.getint('hd44780', 'rows')
                 config['hdd44780_cols'] = cp.getint('hd44780', 'cols')
-                config['hdd44780_d4'] = cp.getint('hd44780', 'd4')
-                config['hdd44780_d5'] = cp.getint('hd44780', 'd5')
-                config['hdd44780_d6'] = cp.getint('hd44780', 'd6')
-                config['hdd44780_d7'] = cp.getint('hd44780', 'd7')
-                config['hdd44780_en'] = cp.getint('hd44780', 'en')
-                config['hdd44780_rs'] = cp.getint('hd44780', 'rs')
+                config['hdd44780_interface'] = cp.get('hd44780', 'interface').lower()
+                if config['hdd44780_interface'] == 'i2c':
+                    config['hdd44780_i2cbus'] = cp.getint('hd44780', 'i2c_bus')
+                    config['hdd44780_i2caddress'] = int(cp.get('hd44780', 'i2c_address'), 0)
+                else:
+                    config['hdd44780_d4'] = cp.getint('hd44780', 'd4')
+                    config['hdd44780_d5'] = cp.getint('hd44780', 'd5')
+                    config['hdd44780_d6'] = cp.getint('hd44780', 'd6')
+                    config['hdd44780_d7'] = cp.getint('hd44780', 'd7')
+                    config['hdd44780_en'] = cp.getint('hd44780', 'en')
+                    config['hdd44780_rs'] = cp.getint('hd44780', 'rs')
             except KeyboardInterrupt:
                 raise
             except:
@@ -549,9 +2632,7 @@ def getconfig(configfile='pwdgen.cfg'):
             # LCDProc
             try:
                 config['lcdproc_host'] = cp.get('lcdproc', 'host')
-                config['lcdproc_port'] = cp.get('lcdproc', 'port')
-                logging.warning('LCDProc not currently supported.')
-                config['lcd_enabled'] = False
+                config['lcdproc_port'] = cp.getint('lcdproc', 'port')
             except KeyboardInterrupt:
                 raise
             except:
@@ -570,12 +2651,36 @@ def getconfig(configfile='pwdgen.cfg'):
             config['button_ground'] = cp.getint('button', 'ground_pin')
         except (ValueError, ConfigParser.NoOptionError):
             config['button_ground'] = -1
+        config['button_pooldepth'] = cp.getint('button', 'pool_depth')
     except KeyboardInterrupt:
         raise
     except:
         logging.exception("Unabled to read button config")
         config['button_enabled'] = False
 
+    # daemon section
+    try:
+        config['daemon_socket'] = os.path.expanduser(cp.get('daemon', 'socket'))
+    except ConfigParser.NoSectionError:
+        config['daemon_socket'] = ''
+    if not config['daemon_socket']:
+        config['daemon_socket'] = defaultsocket()
+
+    # stats section
+    try:
+        config['stats_file'] = os.path.expanduser(cp.get('stats', 'file'))
+        config['stats_format'] = cp.get('stats', 'format').lower()
+        config['stats_interval'] = cp.getfloat('stats', 'interval')
+    except ConfigParser.NoSectionError:
+        config['stats_file'] = ''
+        config['stats_format'] = 'json'
+        config['stats_interval'] = 60.0
+    if config['stats_format'] not in STATS_FORMATS:
+        logging.warning('Invalid stats format (%s) specified. Stats export disabled.' % config['stats_format'])
+        config['stats_file'] = ''
+    if config['stats_interval'] <= 0:
+        config['stats_interval'] = 60.0
+
     # hidkeyboard section
     try:
         config['hidkey_enabled'] = cp.getboolean('hidkeyboard', 'enabled')
@@ -583,6 +2688,11 @@ def getconfig(configfile='pwdgen.cfg'):
         config['hidkey_launch'] = cp.getboolean('hidkeyboard', 'launch')
         config['hidkey_target'] = cp.get('hidkeyboard', 'target').lower()
         config['hidkey_cmddelay'] = cp.getfloat('hidkeyboard','cmd_delay')
+        if cp.get('hidkeyboard', 'report_delay').lower() == 'auto':
+            config['hidkey_reportdelay'] = None
+        else:
+            config['hidkey_reportdelay'] = cp.getfloat('hidkeyboard',
+                                                       'report_delay')
         win_cmd = cp.get('hidkeyboard', 'windows_cmd')
         pixel_cmd = cp.get('hidkeyboard', 'pixel_cmd')
         shell_cmd = cp.get('hidkeyboard', 'shell_cmd')
@@ -606,9 +2716,21 @@ def getconfig(configfile='pwdgen.cfg'):
     except:
         logging.exception("Unabled to read hidkeyboard config")
         config['hidkey_enabled'] = False
+    config['hidkey_timeout'] = getseconds(cp, 'hidkeyboard', 'timeout')
 
     return config
 
+def getseconds(cp, section, option):
+    """return a positive number of seconds from cp, or None if not set"""
+    try:
+        seconds = cp.getfloat(section, option)
+    except (ValueError, ConfigParser.Error):
+        # missing or blank
+        return None
+    if seconds <= 0:
+        return None
+    return seconds
+
 def getargs():
     """parse and return cmdline args"""
 
@@ -633,12 +2755,60 @@ def getargs():
                         default='-1',
                         type=int,
                         help='number of words in each password.')
+    parser.add_argument('--min',
+                        default='-1',
+                        type=int,
+                        help='minimum length of each word.')
+    parser.add_argument('--max',
+                        default='-1',
+                        type=int,
+                        help='maximum length of each word.')
+    parser.add_argument('--total-min',
+                        type=int,
+                        metavar='N',
+                        help='minimum length of each password.')
+    parser.add_argument('--total-max',
+                        type=int,
+                        metavar='N',
+                        help='maximum length of each password.')
     parser.add_argument('passwords',
                         type=int,
                         nargs='?',
 ##                        default=cfg['pwd_generate'],
                         default='-1',
                         help='number of passwords to generate.')
+    parser.add_argument('-j','--jobs',
+                        default=1,
+                        type=int,
+                        help='number of worker processes to generate passwords with. 0 for one per cpu. Default 1.')
+    parser.add_argument('--case',
+                        choices=CASES,
+                        help='letter case of passwords.')
+    parser.add_argument('--serve',
+                        action='store_true',
+                        help='keep running and serve passwords to --client over a unix socket.')
+    parser.add_argument('--client',
+                        action='store_true',
+                        help='get passwords from a pwdgen --serve process.')
+    parser.add_argument('--socket',
+                        metavar='PATH',
+                        help='unix socket for --serve and --client.')
+    parser.add_argument('-u','--unique',
+                        action='store_true',
+                        help='do not repeat any password within a run.')
+    parser.add_argument('--format',
+                        choices=OUTPUT_FORMATS,
+                        default='newline',
+                        help='console output format: one password per line, NUL terminated, csv or json lines. Default newline.')
+    parser.add_argument('--output',
+                        metavar='FILE',
+                        help='write console output to FILE instead of stdout.')
+    parser.add_argument('--stats',
+                        action='store_true',
+                        help='report counters and stage timings on stderr at exit.')
+    parser.add_argument('--profile-startup',
+                        action='store_true',
+                        help='report the time taken by each startup stage on stderr.')
     ex_group = parser.add_mutually_exclusive_group()
     ex_group.add_argument('-q','--quiet',
                           action='store_true',
@@ -667,9 +2837,23 @@ def getopts():
     else:
         logging.basicConfig(level=logging.INFO)
         
-    config = getconfig()
+    config = applyargs(getconfig(), args)
+    try:
+        checkconfig(config)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(str(e))
+
+    if config['button_enabled'] != True:
+        args.once = True
+        
+##    config['pwd_words'] = args.words
+##    config['pwd_generate'] = args.passwords
+
+    return config, args
 
-    # args override config
+def applyargs(config, args):
+    """apply command line overrides to config and return it"""
     if args.console:
         config['lcd_enabled'] = False
         config['hidkey_enabled'] = False
@@ -683,167 +2867,734 @@ def getopts():
         config['pwd_words'] = args.words
     if args.passwords != -1:
         config['pwd_generate'] = args.passwords
+    if args.min != -1:
+        config['pwd_minlength'] = args.min
+    if args.max != -1:
+        config['pwd_maxlength'] = args.max
+    if args.case:
+        config['pwd_case'] = args.case
+    if args.total_min is not None:
+        config['pwd_totalmin'] = args.total_min
+    if args.total_max is not None:
+        config['pwd_totalmax'] = args.total_max
+    if args.socket:
+        config['daemon_socket'] = args.socket
+    if args.serve:
+        args.quiet = True
+        config['lcd_enabled'] = False
+        config['hidkey_enabled'] = False
+    if args.jobs < 1:
+        import multiprocessing
+        args.jobs = multiprocessing.cpu_count()
+    return config
 
-    if config['button_enabled'] != True:
-        args.once = True
-        
-##    config['pwd_words'] = args.words
-##    config['pwd_generate'] = args.passwords
-
-    return config, args
-
-def loadwordlist(source, min_length, max_length):
-    """load word list from source file"""
+def checkconfig(config):
+    """raise ValueError if the [password] options contradict each other"""
+    if config['pwd_minlength'] > config['pwd_maxlength']:
+        raise ValueError('Minimum word length is greater than maximum.')
+    if (config['pwd_totalmin'] is not None
+        and config['pwd_totalmax'] is not None
+        and config['pwd_totalmin'] > config['pwd_totalmax']):
+        raise ValueError('Minimum password length is greater than maximum.')
+
+def changedsections(old, new):
+    """return the set of pwdgen.cfg sections that differ between configs"""
+    return set(CONFIG_SECTIONS.get(key.split('_', 1)[0], key)
+               for key in set(old) | set(new)
+               if old.get(key) != new.get(key))
+
+@timed('loadwordlist')
+def loadwordlist(source, min_length, max_length, cache_dir=None,
+                 compact=False):
+    """load word list from source file
+
+    All usable words are loaded regardless of length and returned as a
+    wordindex. min_length and max_length only set its default range so
+    other ranges can be used later without reloading. Words are lowered
+    and duplicates removed. If compact is True words are held in a
+    compactwords store. Words are kept packed, one buffer per length,
+    until duplicates are removed a length at a time so only the longest
+    bucket is ever held as separate str objects while loading.
+
+    If cache_dir is set the index is kept there in a compiled form that
+    can be loaded with a single read. The cache is rebuilt whenever the
+    source file changes. If the cache cannot be read or written the text
+    file is used instead.
+    """
 
-    wordlist = []
+    cachefile = None
+    key = None
+    if cache_dir:
+        try:
+            cachefile = wordcachepath(cache_dir, source)
+            st = os.stat(source)
+            key = '%s %r %d' % (os.path.realpath(source), st.st_mtime,
+                                st.st_size)
+            wordlist = readwordcache(cachefile, key, min_length, max_length,
+                                     compact)
+            if wordlist is not None:
+                logging.debug('Wordlist loaded from cache %s' % cachefile)
+                return wordlist
+        except (IOError, OSError):
+            # not a damaged cache, which readwordcache() reports as stale
+            # so it is rewritten below, but one that cannot be used at all
+            logging.debug('Wordlist cache unavailable', exc_info=True)
+            cachefile = None
+
+    # newline terminated words, packed by length
+    buckets = {}
     with open(source, 'r') as s:
-        for l in s.readlines():
+        for l in s:
             l = l.rstrip()
-            if l.isalpha() and len(l) >= min_length and len(l) <= max_length:
-                wordlist.append(l.lower())
+            if l.isalpha():
+                b = buckets.get(len(l))
+                if b is None:
+                    b = buckets[len(l)] = bytearray()
+                b += l.lower()
+                b += '\n'
+    words = []
+    counts = []
+    offsets = [0]
+    for n in range(max(buckets) + 1 if buckets else 1):
+        b = buckets.pop(n, None)
+        bucket = []
+        if b:
+            seen = set()
+            bucket = [w for w in str(b).split('\n')[:-1]
+                      if not (w in seen or seen.add(w))]
+            seen = b = None
+        if compact:
+            # back to one str per length, joined up below
+            counts.append((n, len(bucket)))
+            if bucket:
+                words.append('\n'.join(bucket))
+        else:
+            words.extend(bucket)
+        offsets.append(offsets[-1] + len(bucket))
+    if compact:
+        words = compactwords.frombuckets('\n'.join(words), counts)
+    wordlist = wordindex(words, offsets, min_length, max_length)
+
+    if cachefile is not None:
+        try:
+            writewordcache(cachefile, key, wordlist)
+            logging.debug('Wordlist cache written to %s' % cachefile)
+        except (IOError, OSError):
+            # most likely a read only filesystem
+            logging.debug('Unable to write wordlist cache', exc_info=True)
 
     return wordlist
 
-def getword(wordlist, rng):
-    """return random word from wordlist"""
-    return wordlist[rng.randrange(len(wordlist))]
+def wordlistkey(cfg):
+    """return what loadwordlist() depends on in cfg, and the dict's state
 
-def genpwd(wordlist, rng, cfg):
-    """generate random password"""
-    sep = cfg['pwd_seperator']
-    wl = []
-    for n in range(cfg['pwd_words']):
-        while True:
-            w = getword(wordlist, rng)
-            if w not in wl:
-                wl.append(w)
-                break
-    newpwd = ''
-    for i in wl:
-        newpwd += i
-        newpwd += sep[rng.randrange(len(sep))]
-    newpwd = newpwd[:-1]
-    # password mangling
-    # digit prefix
-    prefix = ''
-    if cfg['pwd_prefixd'] > 0:
-        for i in range(cfg['pwd_prefixd']):
-            prefix += str(rng.randint(0, 9))
-    # digit suffix
-    suffix = ''
-    if cfg['pwd_suffixd'] > 0:
-        for i in range(cfg['pwd_suffixd']):
-            suffix += str(rng.randint(0, 9))
-    newpwd = prefix + newpwd + suffix
+    If it is unchanged the wordlist does not need loading again. The
+    length range is left out as every length is loaded, see wordindex.
+    """
+    try:
+        st = os.stat(cfg['pwd_dict'])
+        state = (st.st_mtime, st.st_size)
+    except OSError:
+        state = None
+    return (cfg['pwd_dict'], cfg['pwd_cachedir'], cfg['pwd_compact'], state)
+
+def wordcachepath(cache_dir, source):
+    """return path of the compiled wordlist cache for source"""
+    name = hashlib.sha1(os.path.realpath(source)).hexdigest()
+    return os.path.join(cache_dir, 'wordlist-%s.cache' % name)
+
+def readwordcache(cachefile, key, min_length, max_length, compact=False):
+    """return wordindex from cachefile or None if missing, stale or damaged"""
+    try:
+        with open(cachefile, 'rb') as c:
+            data = c.read()
+    except IOError:
+        return None
+    # split off the header only, the words can be large
+    parts = data[:data.find('\n', len(WORDCACHE_MAGIC) + len(key) + 2)
+                 + 1].split('\n', 3)
+    if len(parts) != 4 or parts[0] != WORDCACHE_MAGIC or parts[1] != key:
+        return None
+    try:
+        offsets = [int(o) for o in parts[2].split(',')]
+    except ValueError:
+        return None
+    start = sum(len(p) + 1 for p in parts[:3])
+    if compact:
+        # the words section is already packed, use it in place
+        try:
+            words = compactwords.frombuckets(
+                buffer(data, start),
+                [(n, offsets[n + 1] - offsets[n])
+                 for n in xrange(len(offsets) - 1)])
+        except ValueError:
+            return None
+    else:
+        words = data[start:].split('\n') if len(data) > start else []
+    if len(words) != offsets[-1]:
+        return None
+    return wordindex(words, offsets, min_length, max_length)
+
+def writewordcache(cachefile, key, wordlist):
+    """atomically write wordindex to cachefile"""
+    cache_dir = os.path.dirname(cachefile)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    import tempfile
+    fd, tmpname = tempfile.mkstemp(dir=cache_dir, prefix='.wordlist-')
+    try:
+        with os.fdopen(fd, 'wb') as c:
+            c.write('\n'.join([WORDCACHE_MAGIC, key,
+                               ','.join(str(o) for o in wordlist.offsets),
+                               '']))
+            if isinstance(wordlist.words, compactwords):
+                c.write(wordlist.words.packed())
+            else:
+                c.write('\n'.join(wordlist.words))
+        os.rename(tmpname, cachefile)
+    except:
+        os.unlink(tmpname)
+        raise
+
+def getword(wordlist, rng, min_length=None, max_length=None):
+    """return random word from wordlist
+
+    If min_length or max_length are given the word is chosen from that
+    range of lengths instead of the wordlist's default range.
+    """
+    if min_length is None and max_length is None:
+        return wordlist[rng.randrange(len(wordlist))]
+    return wordlist.pick(rng, min_length, max_length)
+
+def genpwd(wordlist, rng, cfg, template=None):
+    """generate random password
+
+    template is the result of compiletemplate(cfg). It is compiled here
+    if not given.
+    """
+    if template is None:
+        template = compiletemplate(cfg)
+    return template.generate(wordlist, rng)
+
+def compiletemplate(cfg):
+    """compile the [password] config into a pwdtemplate
+
+    If no template is configured one is built from the words,
+    prefix_digits and suffix_digits options.
+    """
+    spec = cfg['pwd_template']
+    if not spec:
+        spec = ' '.join(filter(None, ['D' * cfg['pwd_prefixd'],
+                                      ' S '.join(['W'] * cfg['pwd_words']),
+                                      'D' * cfg['pwd_suffixd']]))
+    return pwdtemplate(spec,
+                       seperators=cfg['pwd_seperator'],
+                       min_length=cfg['pwd_minlength'],
+                       max_length=cfg['pwd_maxlength'],
+                       mangle=compilemangler(cfg),
+                       total_min=cfg.get('pwd_totalmin'),
+                       total_max=cfg.get('pwd_totalmax'))
+
+def compilemangler(cfg):
+    """compile password mangling options into a function
+
+    Returns mangle(text, rng) which applies leet and letter case as set
+    in cfg. Options are only looked at here, not for every password.
+    mangle.steps names the steps in order, 'leet' then one of the cases,
+    for batchmangle().
+    """
+    names = []
+    steps = []
     # leet speak
     if cfg['pwd_leet']:
-        newpwd = leet(newpwd)
+        names.append('leet')
+        steps.append(lambda text, rng: text.translate(LEET_TABLE))
     # letter case
-    if cfg['pwd_case'] == 'lower':
-        newpwd = newpwd.lower()
-    elif cfg['pwd_case'] == 'upper':
-        newpwd = newpwd.upper()
-    elif cfg['pwd_case'] == 'title':
-        newpwd = newpwd.title()
-    elif cfg['pwd_case'] == 'random':
-        for l in newpwd:
-            if rng.random() > 0.5:
-                vnewpwd += l.upper()
-            else:
-                vnewpwd += l.lower()
-        newpwd = vnewpwd
-        
-    return newpwd
+    case = cfg['pwd_case']
+    if case == 'lower':
+        steps.append(lambda text, rng: text.lower())
+    elif case == 'upper':
+        steps.append(lambda text, rng: text.upper())
+    elif case == 'title':
+        steps.append(lambda text, rng: text.title())
+    elif case == 'random':
+        steps.append(randomcase)
+    if case in ('lower', 'upper', 'title', 'random'):
+        names.append(case)
+
+    def mangle(text, rng):
+        for step in steps:
+            text = step(text, rng)
+        return text
+    mangle.steps = tuple(names)
+    return mangle
+
+def randomcase(text, rng):
+    """return text with each letter randomly upper or lower case"""
+    if not text:
+        return text
+    mask = '{0:0{1}b}'.format(rng.getrandbits(len(text)), len(text))
+    return ''.join([u if m == '1' else l
+                    for l, u, m in zip(text.lower(), text.upper(), mask)])
 
 def leet(text):
     """translate text to leet"""
+    return text.translate(LEET_TABLE)
 
-    leetswap = {'a':'4',
-                'e':'3',
-                'i':'1',
-                'o':'0',
-
-                'l':'1',
-                's':'5',
-                't':'7'}
-
-    for n, l in leetswap.iteritems():
-        text = text.replace(n, l)
-    return text
+@timed('genbatch')
+def genbatch(wordlist, rng, cfg, count, template=None):
+    """generate count passwords at once
 
+    Vectorised equivalent of calling genpwd() count times. All the random
+    values needed are drawn in bulk rather than a few bytes at a time,
+    from rng.randbytes() if it has one, otherwise straight from the
+    kernel. Raises ImportError if numpy is not installed.
+    """
+    import numpy
+
+    if count <= 0:
+        return []
+    if template is None:
+        template = compiletemplate(cfg)
+    if template.lengthlimited:
+        # word lengths depend on each other, sample one at a time
+        return [template.generate(wordlist, rng) for i in xrange(count)]
+    nwords = template.words
+    start, end = wordlist.span(template.min_length, template.max_length)
+    if nwords > end - start:
+        raise ValueError('Only %d words between %s and %s letters long, '
+                         '%d needed.' % (end - start, template.min_length,
+                                         template.max_length, nwords))
+
+    # pick words, redrawing any password that repeats a word. If that
+    # keeps failing the word list is too small for it to work well so
+    # sample the remainder one password at a time.
+    idx = batchrandbelow(end - start, (count, nwords), rng)
+    if nwords > 1:
+        for r in range(BATCH_REDRAWS + 1):
+            srt = numpy.sort(idx, axis=1)
+            dup = (srt[:, 1:] == srt[:, :-1]).any(axis=1)
+            ndup = int(dup.sum())
+            if ndup == 0:
+                break
+            if r < BATCH_REDRAWS:
+                idx[dup] = batchrandbelow(end - start, (ndup, nwords), rng)
+            else:
+                for i in numpy.nonzero(dup)[0]:
+                    idx[i] = rng.sample(xrange(end - start), nwords)
+
+    # assemble passwords column by column
+    words = wordlist.words
+    sep = numpy.frombuffer(template.seperators, dtype=numpy.uint8)
+    columns = []
+    w = 0
+    for kind, value in template.parts:
+        if kind == 'literal':
+            columns.append(itertools.repeat(value, count))
+        elif kind == 'word':
+            columns.append([words[start + j] for j in idx[:, w].tolist()])
+            w += 1
+        elif kind == 'sep':
+            columns.append(sep[batchrandbelow(len(sep), count, rng)]
+                           .view('S1').tolist())
+        elif kind == 'digits':
+            columns.append(batchdigits(count, value, rng))
+    if columns:
+        passwords = map(''.join, itertools.izip(*columns))
+    else:
+        passwords = [''] * count
+
+    # password mangling, the template's own steps done a batch at a time
+    if template.mangle is None:
+        return passwords
+    steps = getattr(template.mangle, 'steps', None)
+    if steps is None:
+        # not from compilemangler(), nothing to vectorise
+        return [template.mangle(p, rng) for p in passwords]
+    return batchmangle(passwords, steps, rng)
+
+def batchmangle(passwords, steps, rng=None):
+    """return passwords with compilemangler() steps applied to all at once
+
+    Random case bits come from rng.randbytes() if rng has one, otherwise
+    straight from the kernel. Raises ValueError for a step it does not
+    know, so it cannot quietly fall behind compilemangler().
+    """
+    import numpy
+
+    randbytes = getattr(rng, 'randbytes', os.urandom)
+
+    for step in steps:
+        if step == 'leet':
+            passwords = [p.translate(LEET_TABLE) for p in passwords]
+        elif step == 'lower':
+            passwords = map(str.lower, passwords)
+        elif step == 'upper':
+            passwords = map(str.upper, passwords)
+        elif step == 'title':
+            passwords = map(str.title, passwords)
+        elif step == 'random' and passwords:
+            buf = numpy.frombuffer('\n'.join(passwords).lower(),
+                                   dtype=numpy.uint8).copy()
+            bits = numpy.unpackbits(numpy.frombuffer(
+                randbytes((len(buf) + 7) // 8), dtype=numpy.uint8))[:len(buf)]
+            flip = (bits == 1) & (buf >= ord('a')) & (buf <= ord('z'))
+            buf[flip] -= 32
+            passwords = buf.tostring().split('\n')
+        elif step != 'random':
+            raise ValueError('Unknown mangle step: %s' % step)
+    return passwords
+
+def batchrandbelow(n, shape, rng=None):
+    """return numpy array of uniform random integers in [0, n)
+
+    Entropy is read in one block, from rng.randbytes() if rng has one or
+    else the kernel. Values that would bias the result are rejected and
+    redrawn.
+    """
+    import numpy
+
+    randbytes = getattr(rng, 'randbytes', os.urandom)
+
+    if n <= 0 or n > 1 << 32:
+        raise ValueError('n out of range (%s)' % n)
+    size = int(numpy.prod(shape))
+    limit = (1 << 32) - (1 << 32) % n
+    out = numpy.empty(size, dtype=numpy.uint32)
+    filled = 0
+    while filled < size:
+        need = size - filled
+        raw = numpy.frombuffer(randbytes(4 * need + 64), dtype=numpy.uint32)
+        raw = raw[raw < limit][:need]
+        out[filled:filled + len(raw)] = raw % n
+        filled += len(raw)
+    return out.reshape(shape)
+
+def batchdigits(count, length, rng=None):
+    """return list of count random strings of length decimal digits"""
+    import numpy
+
+    digits = batchrandbelow(10, (count, length), rng).astype(numpy.uint8) + ord('0')
+    return digits.view('S%d' % length).ravel().tolist()
+
+@timed('genpasswords')
 def genpasswords(wordlist, rng, cfg):
     """generate passwords"""
-    pwdlist = []        
-    for i in range(cfg['pwd_generate']):
-        pwdlist.append(genpwd(wordlist, rng, cfg))
-        
-    return pwdlist
-
-def outputpasswords(passwords, devices):
-    """write passwords to configured devices"""
-    for d in devices:
-        d.launch()
-    i = 1
-    for p in passwords:
+    return list(igenpasswords(wordlist, rng, cfg))
+
+def igenpasswords(wordlist, rng, cfg, jobs=1, unique=False):
+    """generate passwords one at a time
+
+    Passwords are produced in batches of at most BATCH_SIZE so memory
+    use does not grow with the number requested. If jobs is more than 1
+    the batches are generated by that many worker processes. If unique
+    is True no password is repeated.
+    """
+    count = cfg['pwd_generate']
+    if unique:
+        for p in iuniquepasswords(wordlist, rng, cfg, jobs):
+            yield p
+        return
+    if jobs > 1 and count > BATCH_SIZE:
+        for p in poolgenpasswords(wordlist, cfg, jobs):
+            yield p
+        return
+    template = compiletemplate(cfg)
+    if count >= BATCH_MIN:
+        try:
+            while count > 0:
+                batch = genbatch(wordlist, rng, cfg, min(count, BATCH_SIZE),
+                                 template)
+                count -= len(batch)
+                for p in batch:
+                    yield p
+            return
+        except ImportError:
+            logging.debug('numpy not available, using genpwd()')
+
+    for i in xrange(count):
+        yield template.generate(wordlist, rng)
+
+def iuniquepasswords(wordlist, rng, cfg, jobs=1):
+    """generate passwords with no repeats
+
+    Duplicates are dropped and replaced until enough unique passwords
+    have been produced. Seen passwords are tracked exactly for up to
+    UNIQUE_SET_MAX passwords. Beyond that a bloom filter is used, which
+    very occasionally drops a password that was not a repeat.
+    """
+    remaining = cfg['pwd_generate']
+    if remaining > UNIQUE_SET_MAX:
+        seen = bloomfilter(remaining, UNIQUE_ERROR_RATE)
+    else:
+        seen = uniqueset()
+    misses = 0
+    while remaining > 0:
+        for p in igenpasswords(wordlist, rng,
+                               dict(cfg, pwd_generate=remaining), jobs):
+            if seen.add(p):
+                remaining -= 1
+                misses = 0
+                yield p
+            else:
+                misses += 1
+                if misses > UNIQUE_MAX_MISSES:
+                    raise ValueError('Unable to generate enough unique '
+                                     'passwords.')
+
+def poolgenpasswords(wordlist, cfg, jobs):
+    """generate passwords across jobs worker processes
+
+    The workers are forked after the wordlist is loaded so they share it
+    rather than each loading or being sent a copy. Each has its own
+    random generator. Batches are returned in order and only a few per
+    worker are queued at any time to keep memory use bounded.
+    """
+    import multiprocessing
+
+    count = cfg['pwd_generate']
+    sizes = iter([BATCH_SIZE] * (count // BATCH_SIZE) +
+                 ([count % BATCH_SIZE] if count % BATCH_SIZE else []))
+    pool = multiprocessing.Pool(jobs, poolinit, (wordlist, cfg))
+    try:
+        pending = collections.deque()
+        for n in sizes:
+            pending.append(pool.apply_async(poolworker, (n,)))
+            if len(pending) >= jobs * POOL_BACKLOG:
+                break
+        while pending:
+            # a timeout keeps ctrl-c working under python 2
+            batch = pending.popleft().get(0xFFFF)
+            n = next(sizes, None)
+            if n is not None:
+                pending.append(pool.apply_async(poolworker, (n,)))
+            for p in batch:
+                yield p
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def poolinit(wordlist, cfg):
+    """set up a poolgenpasswords() worker process"""
+    global g_pool_state
+    # ctrl-c is handled by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    g_pool_state = (wordlist, cfg, getrng(cfg['pwd_rng']))
+
+def poolworker(count):
+    """generate a batch of count passwords in a worker process"""
+    wordlist, cfg, rng = g_pool_state
+    cfg = dict(cfg, pwd_generate=count)
+    return genpasswords(wordlist, rng, cfg)
+
+def outputpasswords(passwords, devices, wait=True, timeout=None, cancel=None):
+    """write passwords to configured devices
+
+    passwords may be any iterable. It is consumed as it is written.
+    Devices wrapped in a devicequeue run concurrently. If wait is True
+    this returns once each has finished or its timeout has passed.
+    timeout overrides the devices' own, see devicetimeout().
+    cancel is an optional threading.Event. Once it is set no more
+    passwords are written. Output already queued is dropped by whoever
+    sets it, with each device's cancel().
+    """
+    with g_stats.timer('output'):
         for d in devices:
-            d.write(i, p)
-        i += 1
+            d.launch()
+        i = 0
+        for p in passwords:
+            if cancel is not None and cancel.is_set():
+                break
+            i += 1
+            for d in devices:
+                d.write(i, p)
+        for d in devices:
+            d.flush()
+        if wait:
+            for d in devices:
+                if not d.wait(timeout):
+                    logging.warning('Timed out waiting for %s.'
+                                    % devicename(d))
+    g_stats.count('passwords', i)
 
 
 ## main   
 if __name__ == '__main__':
+    exporter = None
     try:
-        rng = random.SystemRandom()
-        g_run_threads = True
         cfg, args = getopts()
+        markstartup('config')
+        rng = getrng(cfg['pwd_rng'])
         # set global debug flag
         _DEBUG = args.debug
 
+        if args.client:
+            # only the options given on the command line are sent, the
+            # server's config supplies the rest
+            request = {'unique':args.unique}
+            for key, value in (('count', args.passwords),
+                               ('words', args.words),
+                               ('min', args.min),
+                               ('max', args.max),
+                               ('total_min', args.total_min),
+                               ('total_max', args.total_max)):
+                if value not in (-1, None):
+                    request[key] = value
+            if args.case:
+                request['case'] = args.case
+            try:
+                passwords = requestpasswords(cfg['daemon_socket'], request)
+            except IOError as e:
+                # includes socket.error
+                logging.error('Unable to get passwords from %s (%s)'
+                              % (cfg['daemon_socket'], e))
+                sys.exit('Unable to reach pwdgen server.')
+            except ValueError as e:
+                logging.error(e)
+                sys.exit(str(e))
+            lcds = [console(enabled=True, output=args.output,
+                            format=args.format)]
+            outputpasswords(passwords, lcds)
+            sys.exit(0)
+
         lcds = []
         # console output
         if args.quiet == False:
-            lcds = [console(enabled=True)]
+            lcds = [console(enabled=True,
+                            output=args.output,
+                            format=args.format)]
 
         if cfg['lcd_enabled']:
             if cfg['lcd_type'] == 'hd44780':
-                lcds.append(hd44780(enabled=True,
-                            rows=cfg['hdd44780_rows'],
-                            cols=cfg['hdd44780_cols'],
-                            d4=cfg['hdd44780_d4'],
-                            d5=cfg['hdd44780_d5'],
-                            d6=cfg['hdd44780_d6'],
-                            d7=cfg['hdd44780_d7'],
-                            en=cfg['hdd44780_en'],
-                            rs=cfg['hdd44780_rs']))
+                if cfg['hdd44780_interface'] == 'i2c':
+                    try:
+                        lcds.append(hd44780(enabled=True,
+                                    rows=cfg['hdd44780_rows'],
+                                    cols=cfg['hdd44780_cols'],
+                                    transport=hd44780i2c(
+                                        bus=cfg['hdd44780_i2cbus'],
+                                        address=cfg['hdd44780_i2caddress'])))
+                    except (ImportError, IOError):
+                        logging.exception('Unable to open i2c lcd. HD44780 output disabled.')
+                else:
+                    lcds.append(hd44780(enabled=True,
+                                rows=cfg['hdd44780_rows'],
+                                cols=cfg['hdd44780_cols'],
+                                d4=cfg['hdd44780_d4'],
+                                d5=cfg['hdd44780_d5'],
+                                d6=cfg['hdd44780_d6'],
+                                d7=cfg['hdd44780_d7'],
+                                en=cfg['hdd44780_en'],
+                                rs=cfg['hdd44780_rs']))
             elif cfg['lcd_type'] == 'lcdproc':
-                logging.warning('LCDProc not currently supported.')
+                lcds.append(lcdproc(enabled=True,
+                                    host=cfg['lcdproc_host'],
+                                    port=cfg['lcdproc_port']))
 
         if cfg['hidkey_enabled']:
             lcds.append(hidkey(enabled=True,
                                device=cfg['hidkey_device'],
                                launch=cfg['hidkey_launch'],
                                target=cfg['hidkey_target'],
-                               cmd=cfg['hidkey_cmd']))
+                               cmd=cfg['hidkey_cmd'],
+                               cmd_delay=cfg['hidkey_cmddelay'],
+                               report_delay=cfg['hidkey_reportdelay'],
+                               timeout=cfg['hidkey_timeout']))
+        if args.stats or cfg['stats_file']:
+            lcds = [timeddevice(l) for l in lcds]
+        # run devices side by side so the slowest sets the pace
+        if len(lcds) > 1:
+            lcds = [devicequeue(l, timeout=devicetimeout(l, cfg))
+                    for l in lcds]
+
         logging.debug('Loading wordlist...')
-        wordlist = loadwordlist(cfg['pwd_dict'], cfg['pwd_minlength'], cfg['pwd_maxlength'])
+        wordlist = loadwordlist(cfg['pwd_dict'], cfg['pwd_minlength'],
+                                cfg['pwd_maxlength'], cfg['pwd_cachedir'],
+                                cfg['pwd_compact'])
+        markstartup('wordlist')
         logging.debug('...Done')
-
-        if args.once:
-            outputpasswords(genpasswords(wordlist=wordlist,
-                                         rng=rng,
-                                         cfg=cfg),
-                            lcds)
+        try:
+            template = compiletemplate(cfg)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(str(e))
+        available = wordlist.count(cfg['pwd_minlength'], cfg['pwd_maxlength'])
+        if available < template.words:
+            msg = ('Only %d words between %d and %d letters long in %s, '
+                   '%d needed.' % (available, cfg['pwd_minlength'],
+                                   cfg['pwd_maxlength'], cfg['pwd_dict'],
+                                   template.words))
+            logging.error(msg)
+            sys.exit(msg)
+        try:
+            template.plan(wordlist)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(str(e))
+
+        if cfg['stats_file'] and (args.serve or (cfg['button_enabled']
+                                                 and not args.once)):
+            exporter = statsexporter(cfg['stats_file'], cfg['stats_format'],
+                                     cfg['stats_interval'])
+            exporter.start()
+
+        if args.serve:
+            handlesignals()
+            try:
+                server = pwdserver(cfg['daemon_socket'], wordlist, rng, cfg)
+            except IOError as e:
+                # includes socket.error
+                logging.error(e)
+                sys.exit(str(e))
+            serve = threading.Thread(target=server.serve_forever,
+                                     name='pwdserver')
+            serve.daemon = True
+            serve.start()
+            markstartup('ready')
+            logging.info('Serving passwords on %s' % cfg['daemon_socket'])
+            while not g_shutdown.is_set():
+                waitforwakeup()
+            server.shutdown()
+            server.server_close()
+        elif args.once:
+            try:
+                passwords = igenpasswords(wordlist=wordlist, rng=rng,
+                                          cfg=cfg, jobs=args.jobs,
+                                          unique=args.unique)
+                outputpasswords(onfirst(timediter('genpasswords', passwords),
+                                        lambda: markstartup('first output')),
+                                lcds)
+            except ValueError as e:
+                # request cannot be satisfied with this wordlist
+                logging.error(e)
+                sys.exit(str(e))
         elif cfg['button_enabled']:
-            button = cmdbutton(cfg, lcds, wordlist, rng)
+            handlesignals(hup=onreload)
+            button = cmdbutton(cfg, lcds, wordlist, rng,
+                               lambda: applyargs(getconfig(), args))
+            markstartup('ready')
             button.run()
-            while True:
-                time.sleep(1)
             
     finally:
-        g_run_threads = False
+        g_shutdown.set()
         try:
             for l in lcds:
                 l.close()
         except:
             pass
+        try:
+            if args.profile_startup:
+                reportstartup()
+            if args.stats:
+                g_stats.report()
+            if exporter is not None:
+                # one last time so the file is up to date
+                g_stats.export(cfg['stats_file'], cfg['stats_format'])
+        except NameError:
+            # exited before the arguments were parsed
+            pass
+        except (IOError, OSError) as e:
+            logging.warning('Unable to write stats to %s (%s)'
+                            % (cfg['stats_file'], e))
         